@@ -0,0 +1,252 @@
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold-start and import-time benchmark for the six Lambda handlers.
+#
+# For every handler it runs, each in a fresh interpreter:
+#   - `python -X importtime -c "import apiN"`, summarised per top-level package
+#   - a child that imports the handler, builds the S3 client (when boto3 is installed), then
+#     invokes lambda_handler once cold and --warm times warm against the local stubs in
+#     stubs.py (in-memory S3, in-process scraper and niche APIs)
+#
+#   python coldstart_bench.py                       # all handlers, table on stdout
+#   python coldstart_bench.py --handlers api5 api6 --runs 10 --warm 50
+#   python coldstart_bench.py --output before.json  # save a baseline
+#   python coldstart_bench.py --baseline before.json  # compare against it
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(os.path.dirname(HERE), "lambdafunctions")
+LAYERS_DIR = os.path.join(LAMBDA_DIR, "lambda-layers")
+HANDLERS = ["api1", "api2", "api3", "api4", "api5", "api6"]
+
+
+def child_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([LAMBDA_DIR, LAYERS_DIR, HERE])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    # Pace nothing, the benchmark measures the handlers rather than the provider quota
+    env.setdefault("SCRAPER_RATE_LIMIT_RPS", "1000000")
+    env.setdefault("SCRAPER_RATE_LIMIT_BURST", "1000000")
+    return env
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+# Import time
+
+
+def parse_importtime(stderr, root):
+    # Lines look like "import time:       123 |        456 |   json.decoder", children first
+    # and indented two spaces per level under the module that imported them. Returns
+    # (name, self us, cumulative us) for root and everything imported on its behalf, leaving
+    # out what the interpreter loaded at startup.
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            depth = len(name) - len(name.lstrip()) - 1
+            modules.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue
+
+    for end, (name, depth, _, _) in enumerate(modules):
+        if name == root:
+            start = end
+            while start > 0 and modules[start - 1][1] > depth:
+                start -= 1
+            return [(name, self_us, cumulative_us) for name, _, self_us, cumulative_us in modules[start:end + 1]]
+    raise ValueError(f"{root} not found in the -X importtime output")
+
+
+def measure_imports(handler, runs):
+    totals = []
+    packages = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {handler}"],
+            cwd=LAMBDA_DIR, env=child_env(), capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"import {handler} failed:\n{result.stderr[-2000:]}")
+        modules = parse_importtime(result.stderr, handler)
+        totals.append(next(cumulative for name, _, cumulative in modules if name == handler) / 1000)
+        for name, self_us, _ in modules:
+            package = name.split(".")[0]
+            packages.setdefault(package, []).append(self_us / 1000)
+
+    # Per package: its self time summed over its modules, averaged over the runs
+    package_ms = {package: sum(values) / runs for package, values in packages.items()}
+    return {
+        "import_ms_p50": statistics.median(totals),
+        "import_ms_min": min(totals),
+        "packages_ms": dict(sorted(package_ms.items(), key=lambda item: item[1], reverse=True))
+    }
+
+
+# Handler latency
+
+
+def run_child(handler, warm):
+    # Runs inside the fresh interpreter and prints one JSON line
+    started = time.perf_counter()
+    module = importlib.import_module(handler)
+    import_ms = (time.perf_counter() - started) * 1000
+    heavy_after_import = sorted(name for name in ("boto3", "botocore", "requests", "urllib3") if name in sys.modules)
+
+    client_ms = None
+    try:
+        started = time.perf_counter()
+        from s3fetch import make_s3_client
+        make_s3_client()
+        client_ms = (time.perf_counter() - started) * 1000
+    except Exception:
+        pass  # boto3 is not installed here, the stub client costs nothing to build
+
+    import stubs
+    fake = stubs.install_s3(stubs.FakeS3())
+    stubs.seed_objects(fake)
+    stubs.install_http(stubs.FakeSession())
+    event = stubs.EVENTS[handler]
+
+    def invoke():
+        output = io.StringIO()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            response = module.lambda_handler(copy.deepcopy(event), None)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        status = response.get("statusCode", 200) if isinstance(response, dict) else None
+        return elapsed_ms, status
+
+    cold_ms, cold_status = invoke()
+    warm_ms = []
+    statuses = {cold_status}
+    for _ in range(warm):
+        elapsed_ms, status = invoke()
+        warm_ms.append(elapsed_ms)
+        statuses.add(status)
+
+    print(json.dumps({
+        "import_ms": import_ms,
+        "client_ms": client_ms,
+        "cold_invoke_ms": cold_ms,
+        "warm_ms": warm_ms,
+        "statuses": sorted(statuses, key=str),
+        "heavy_after_import": heavy_after_import,
+        "s3_requests": fake.requests
+    }))
+
+
+def measure_latency(handler, runs, warm):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", handler, "--warm", str(warm)],
+            cwd=LAMBDA_DIR, env=child_env(), capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"{handler} benchmark failed:\n{result.stderr[-2000:]}")
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    cold_total = [sample["import_ms"] + sample["cold_invoke_ms"] for sample in samples]
+    warm_ms = [value for sample in samples for value in sample["warm_ms"]]
+    client_ms = [sample["client_ms"] for sample in samples if sample["client_ms"] is not None]
+    return {
+        "cold_ms_p50": percentile(cold_total, 50),
+        "cold_ms_p90": percentile(cold_total, 90),
+        "cold_invoke_ms_p50": percentile([sample["cold_invoke_ms"] for sample in samples], 50),
+        "client_ms_p50": percentile(client_ms, 50),
+        "warm_ms_p50": percentile(warm_ms, 50),
+        "warm_ms_p90": percentile(warm_ms, 90),
+        "warm_ms_p99": percentile(warm_ms, 99),
+        "statuses": sorted({status for sample in samples for status in sample["statuses"]}, key=str),
+        "heavy_after_import": samples[0]["heavy_after_import"]
+    }
+
+
+# Reporting
+
+
+def fmt(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_report(results, top, baseline=None):
+    print(f"{'handler':8} {'import':>8} {'client':>8} {'cold p50':>9} {'cold p90':>9} "
+          f"{'warm p50':>9} {'warm p90':>9} {'warm p99':>9}  status")
+    for handler, result in results.items():
+        print(f"{handler:8} {fmt(result['import_ms_p50']):>8} {fmt(result['client_ms_p50']):>8} "
+              f"{fmt(result['cold_ms_p50']):>9} {fmt(result['cold_ms_p90']):>9} {fmt(result['warm_ms_p50']):>9} "
+              f"{fmt(result['warm_ms_p90']):>9} {fmt(result['warm_ms_p99']):>9}  {result['statuses']}")
+    print("(ms; import from -X importtime, cold = import + first invocation, client = boto3 S3 client build)")
+
+    print()
+    for handler, result in results.items():
+        packages = ", ".join(f"{package} {ms:.1f}" for package, ms in list(result["packages_ms"].items())[:top])
+        print(f"{handler}: {packages}")
+        if result["heavy_after_import"]:
+            print(f"{handler}: loads {', '.join(result['heavy_after_import'])} at import time")
+
+    if baseline:
+        print()
+        print("Change against baseline (positive is slower):")
+        for handler, result in results.items():
+            before = baseline.get(handler)
+            if not before:
+                continue
+            changes = []
+            for metric in ("import_ms_p50", "cold_ms_p50", "warm_ms_p50", "warm_ms_p99"):
+                if before.get(metric) and result.get(metric) is not None:
+                    changes.append(f"{metric} {100 * (result[metric] - before[metric]) / before[metric]:+.0f}%")
+            print(f"{handler}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time and cold/warm latency benchmark for the Lambda handlers")
+    parser.add_argument("--handlers", nargs="+", default=HANDLERS, choices=HANDLERS)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per handler")
+    parser.add_argument("--warm", type=int, default=20, help="warm invocations per interpreter")
+    parser.add_argument("--top", type=int, default=8, help="packages listed per handler")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a JSON file written with --output")
+    parser.add_argument("--child", choices=HANDLERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warm)
+        return
+
+    results = {}
+    for handler in args.handlers:
+        results[handler] = dict(measure_imports(handler, args.runs), **measure_latency(handler, args.runs, args.warm))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["handlers"]
+    print_report(results, args.top, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "created_at": time.time(), "handlers": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
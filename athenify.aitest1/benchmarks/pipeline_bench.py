@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+# Offline end-to-end benchmark of api1 -> api2 -> api3 -> api4 -> api5 -> api6.
+#
+# The handlers run in this process against
+#   - a local HTTP server standing in for the Instagram scraper (following lists, profiles,
+#     reels) and the niche endpoint, with configurable latency and injected 429s
+#   - a filesystem-backed S3 stand-in under a temporary directory
+# and the run is repeated for each follow-list size, reporting creators/sec, LLM calls per
+# creator and the bytes each stage moved over HTTP and S3.
+#
+#   python pipeline_bench.py                                   # sizes 10 100 1000 10000
+#   python pipeline_bench.py --sizes 100 1000 --latency-ms 50 --rate-429 0.02
+#   python pipeline_bench.py --niche-batch-size 1 --output single.json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(os.path.dirname(HERE), "lambdafunctions")
+LAYERS_DIR = os.path.join(LAMBDA_DIR, "lambda-layers")
+
+SEED = "seed"
+REELS_BUCKET = "instascraper"
+
+
+# Fake scraper and niche API
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    # Routes on the request itself, since the handlers' real endpoints are not configured here:
+    #   POST                        -> niche classification (one LLM call, batched or not)
+    #   GET ?username_or_id=...     -> following list, paginated with pagination_token
+    #   GET /<username>?count=...   -> reels feed
+    #   GET /                       -> profile with the follower count
+    daemon_threads = True
+
+    def __init__(self, following, reels, latency_ms, niche_latency_ms, rate_429, retry_after, niche_pass_rate):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.following = following
+        self.reels = reels
+        self.latency_ms = latency_ms
+        self.niche_latency_ms = niche_latency_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.niche_pass_rate = niche_pass_rate
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, route, bytes_in, bytes_out, status):
+        with self.lock:
+            stats = self.stats.setdefault(route, {"requests": 0, "429s": 0, "bytes_in": 0, "bytes_out": 0})
+            stats["requests"] += 1
+            stats["429s"] += status == 429
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as the handlers' pooled sessions expect
+    disable_nagle_algorithm = True  # Otherwise delayed ACKs add ~40 ms to every keep-alive response
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, route, status, payload, bytes_in, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(route, bytes_in, len(body), status)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"null")
+        time.sleep(self.server.niche_latency_ms / 1000)
+
+        rng = self.server.rng
+        with self.server.lock:
+            if request and "messages" in request:
+                payload = {"results": {message["username"]: {"match": int(rng.random() < self.server.niche_pass_rate)}
+                                       for message in request["messages"]}}
+            else:
+                payload = {"match": int(rng.random() < self.server.niche_pass_rate)}
+        self._send("niche", 200, payload, length)
+
+    def do_GET(self):
+        import stubs
+
+        parsed = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(parsed.query).items()}
+        username = unquote(parsed.path.strip("/"))
+        if "username_or_id" in query:
+            route = "following"
+        elif username and "count" in query:
+            route = "reels"
+        else:
+            route = "profile"
+        time.sleep(self.server.latency_ms / 1000)
+
+        with self.server.lock:
+            throttled = self.server.rng.random() < self.server.rate_429
+        if throttled:
+            self._send(route, 429, {"message": "Too many requests"}, 0, {"Retry-After": str(self.server.retry_after)})
+            return
+
+        if route == "following":
+            payload = stubs.scraper_payload(query["username_or_id"], query, reels=0, following=self.server.following)
+            payload["data"] = {"users": payload["data"]["users"]}
+        elif route == "reels":
+            payload = stubs.scraper_payload(username, query, reels=self.server.reels)
+            payload["data"] = {"items": payload["data"]["items"]}
+            payload["pagination_token"] = None
+        else:
+            with self.server.lock:
+                payload = {"data": {"edge_followed_by": {"count": self.server.rng.randint(1_000, 100_000)}}}
+        self._send(route, 200, payload, 0)
+
+
+def make_routing_session(base_url):
+    # The handlers' endpoints are placeholders, so every request is sent to the fake server,
+    # keeping its path and query. Their placeholder header sets are dropped on the way.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class RoutingSession(requests.Session):
+        def request(self, method, url, headers=None, **kwargs):
+            path = quote(urlparse(url).path.strip("/") if "://" in url else url.strip("/"))
+            if method.upper() == "POST":
+                path = "niche"
+            if not isinstance(headers, dict):
+                headers = None
+            return super().request(method, f"{base_url}/{path}", headers=headers, **kwargs)
+
+    session = RoutingSession()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=64)
+    session.mount("http://", adapter)
+    return session
+
+
+# Filesystem-backed S3
+
+
+def filesystem_s3_class():
+    import stubs
+
+    class FilesystemS3(stubs.FakeS3):
+        # Objects live under root/bucket/key, with their metadata in a sidecar file
+        def __init__(self, root):
+            super().__init__()
+            self.root = root
+
+        def _path(self, bucket, key):
+            return os.path.join(self.root, bucket, *key.split("/"))
+
+        def _load(self, bucket, key):
+            path = self._path(bucket, key)
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+            except (FileNotFoundError, IsADirectoryError):
+                return None
+            try:
+                with open(path + ".meta", "r") as f:
+                    metadata = json.load(f)
+            except FileNotFoundError:
+                metadata = {}
+            return body, metadata
+
+        def _store(self, bucket, key, body, metadata):
+            path = self._path(bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(path + ".tmp", path)
+            if metadata:
+                with open(path + ".meta", "w") as f:
+                    json.dump(metadata, f)
+
+        def _drop(self, bucket, key):
+            for path in (self._path(bucket, key), self._path(bucket, key) + ".meta"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    return FilesystemS3
+
+
+# Pipeline
+
+
+def reset_caches():
+    # Every size starts from a cold container, not from the previous size's caches
+    import api3
+    import nichecache
+    import s3cache
+
+    api3._follower_counts.clear()
+    with nichecache.niche_cache.lock:
+        nichecache.niche_cache.entries.clear()
+    with s3cache.object_cache.lock:
+        s3cache.object_cache.entries.clear()
+        s3cache.object_cache.size = 0
+
+
+def invoke(module, body):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        response = module.lambda_handler({"body": json.dumps(body)}, None)
+    if isinstance(response, dict) and "statusCode" in response:
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"{module.__name__} returned {response['statusCode']}: {response['body'][:500]}")
+        return json.loads(response["body"])
+    return response  # api5/api6 return their validation errors unwrapped
+
+
+def run_pipeline(size, args):
+    import api1, api2, api3, api4, api5, api6
+    import stubs
+
+    server = FakeApiServer(size, args.reels, args.latency_ms, args.niche_latency_ms, args.rate_429,
+                           args.retry_after, args.niche_pass_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root = tempfile.mkdtemp(prefix="athenify-s3-")
+    try:
+        s3 = stubs.install_s3(filesystem_s3_class()(root))
+        stubs.install_http(make_routing_session(server.base_url))
+        reset_caches()
+
+        stages = []
+
+        def stage(name, creators_in, func):
+            http_before, s3_before = server.snapshot(), (s3.requests, s3.bytes_in, s3.bytes_out)
+            started = time.perf_counter()
+            creators_out = func()
+            seconds = time.perf_counter() - started
+            http_after = server.snapshot()
+            routes = {}
+            for route, after in http_after.items():
+                before = http_before.get(route, {})
+                delta = {key: value - before.get(key, 0) for key, value in after.items()}
+                if delta["requests"]:
+                    routes[route] = delta
+            stages.append({
+                "stage": name,
+                "creators_in": creators_in,
+                "creators_out": len(creators_out),
+                "seconds": seconds,
+                # api1/api2 turn one seed into many creators, the other stages narrow the list
+                "creators_per_sec": max(creators_in, len(creators_out)) / seconds if seconds else None,
+                "http": routes,
+                "http_bytes": sum(route["bytes_in"] + route["bytes_out"] for route in routes.values()),
+                "s3_requests": s3.requests - s3_before[0],
+                "s3_bytes_written": s3.bytes_in - s3_before[1],
+                "s3_bytes_read": s3.bytes_out - s3_before[2]
+            })
+            return creators_out
+
+        # api1: ingest the seed's following list
+        stage("api1", 1, lambda: invoke(api1, {"username": SEED, "max_users": size})["successful_usernames"])
+
+        # api2: read it back page by page, the way the frontend does
+        def read_list():
+            creators, offset = [], 0
+            while offset is not None:
+                page = invoke(api2, {"username": SEED, "offset": offset, "limit": args.page_limit})
+                creators.extend(page["data"])
+                offset = page["next_offset"]
+            return creators
+        creators = stage("api2", 1, read_list)
+
+        # api3: follower-count and niche filters
+        survivors = stage("api3", len(creators), lambda: invoke(api3, {
+            "usernames": creators,
+            "niche": "fitness",
+            "level": "broad",
+            "followercount": str(args.follower_limit),
+            "niche_batch_size": args.niche_batch_size,
+            "max_workers": args.max_workers
+        })["successful_usernames"])
+
+        # api4: reels of the survivors
+        def fetch_reels():
+            stored = invoke(api4, {"usernames": survivors, "api_key": "local", "bucket_name": REELS_BUCKET})["data"]
+            return [result["username"] for result in stored]
+        with_reels = stage("api4", len(survivors), fetch_reels)
+
+        # api5: per-creator top videos, then api6: the leaderboard across them
+        def rank():
+            errors = invoke(api5, {"usernames": with_reels}).get("errors", {})
+            failed = {username for usernames in errors.values() for username in usernames}
+            return [username for username in with_reels if username not in failed]
+        ranked = stage("api5", len(with_reels), rank)
+        stage("api6", len(ranked), lambda: invoke(api6, {"usernames": ranked, "X": 10})["data"])
+
+        total_seconds = sum(entry["seconds"] for entry in stages)
+        niche_calls = server.snapshot().get("niche", {}).get("requests", 0)
+        return {
+            "size": size,
+            "creators": len(creators),
+            "survivors": len(survivors),
+            "seconds": total_seconds,
+            "creators_per_sec": len(creators) / total_seconds if total_seconds else None,
+            "llm_calls": niche_calls,
+            "llm_calls_per_creator": niche_calls / len(creators) if creators else None,
+            "ranked": len(ranked),
+            "stages": stages
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# Reporting
+
+
+def fmt_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def print_report(result):
+    print(f"follow list of {result['size']}: {result['creators']} creators, {result['survivors']} passed api3, "
+          f"{result['seconds']:.2f} s, {result['creators_per_sec']:.1f} creators/s, "
+          f"{result['llm_calls']} LLM calls ({result['llm_calls_per_creator']:.2f} per creator)")
+    print(f"  {'stage':6} {'in':>6} {'out':>6} {'seconds':>8} {'creators/s':>10} {'http reqs':>9} {'429s':>5} "
+          f"{'http bytes':>10} {'s3 reqs':>7} {'s3 read':>9} {'s3 written':>10}")
+    for entry in result["stages"]:
+        requests = sum(route["requests"] for route in entry["http"].values())
+        throttled = sum(route["429s"] for route in entry["http"].values())
+        rate = f"{entry['creators_per_sec']:.1f}" if entry["creators_per_sec"] is not None else "-"
+        print(f"  {entry['stage']:6} {entry['creators_in']:>6} {entry['creators_out']:>6} {entry['seconds']:>8.2f} "
+              f"{rate:>10} {requests:>9} {throttled:>5} {fmt_bytes(entry['http_bytes']):>10} "
+              f"{entry['s3_requests']:>7} {fmt_bytes(entry['s3_bytes_read']):>9} {fmt_bytes(entry['s3_bytes_written']):>10}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the api1-api6 pipeline")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000], help="follow-list sizes")
+    parser.add_argument("--latency-ms", type=float, default=5, help="scraper latency per request")
+    parser.add_argument("--niche-latency-ms", type=float, default=50, help="niche endpoint latency per request")
+    parser.add_argument("--rate-429", type=float, default=0.01, help="share of scraper requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--reels", type=int, default=12, help="reels returned per creator")
+    parser.add_argument("--niche-pass-rate", type=float, default=0.5)
+    parser.add_argument("--follower-limit", type=int, default=50_000, help="api3 followercount")
+    parser.add_argument("--niche-batch-size", type=int, default=5)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--page-limit", type=int, default=1000, help="api2 page size")
+    parser.add_argument("--scraper-rps", type=float, default=1_000_000, help="scraper rate limit, unpaced by default")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Read by the handler modules at import time
+    os.environ["SCRAPER_RATE_LIMIT_RPS"] = str(args.scraper_rps)
+    os.environ["SCRAPER_RATE_LIMIT_BURST"] = str(max(1, args.scraper_rps))
+    for path in (HERE, LAYERS_DIR, LAMBDA_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    results = []
+    for size in args.sizes:
+        result = run_pipeline(size, args)
+        print_report(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "created_at": time.time(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
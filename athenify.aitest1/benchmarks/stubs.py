@@ -0,0 +1,302 @@
+import hashlib
+import io
+import json
+import random
+import sys
+import threading
+import types
+
+# Local stand-ins for S3 and the scraper / niche HTTP APIs, so the handlers can be benchmarked
+# offline with their real code paths. Only the calls the handlers make are implemented.
+
+
+def _client_error_class():
+    # The handlers catch botocore's ClientError and BotoCoreError. When botocore is not
+    # installed a minimal module with the same constructors is registered so they still
+    # import and run.
+    try:
+        from botocore.exceptions import ClientError
+        return ClientError
+    except ImportError:
+        pass
+
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            self.response = error_response
+            self.operation_name = operation_name
+            super().__init__(f"An error occurred ({error_response.get('Error', {}).get('Code')}) when calling the {operation_name} operation")
+
+    botocore = types.ModuleType("botocore")
+    exceptions = types.ModuleType("botocore.exceptions")
+    exceptions.ClientError = ClientError
+    exceptions.BotoCoreError = type("BotoCoreError", (Exception,), {})
+    botocore.exceptions = exceptions
+    sys.modules.setdefault("botocore", botocore)
+    sys.modules.setdefault("botocore.exceptions", exceptions)
+    return ClientError
+
+
+class FakeS3:
+    # Dict-backed S3 client. Subclasses can override _load/_store/_drop to keep the objects
+    # somewhere else (see the filesystem store of the pipeline benchmark).
+    def __init__(self):
+        ClientError = _client_error_class()
+        self.ClientError = ClientError
+        self.exceptions = types.SimpleNamespace(NoSuchKey=type("NoSuchKey", (ClientError,), {}))
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Storage
+
+    def _load(self, bucket, key):
+        return self.objects.get((bucket, key))
+
+    def _store(self, bucket, key, body, metadata):
+        self.objects[(bucket, key)] = (body, metadata)
+
+    def _drop(self, bucket, key):
+        self.objects.pop((bucket, key), None)
+
+    # Helpers
+
+    @staticmethod
+    def _etag(body):
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def _error(self, code, operation, status):
+        error = {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+        if code == "NoSuchKey":
+            return self.exceptions.NoSuchKey(error, operation)
+        return self.ClientError(error, operation)
+
+    def _get(self, bucket, key, operation):
+        with self.lock:
+            self.requests += 1
+            stored = self._load(bucket, key)
+        if stored is None:
+            raise self._error("NoSuchKey" if operation == "GetObject" else "404", operation, 404)
+        return stored
+
+    def put_json(self, bucket, key, data):
+        self._store(bucket, key, json.dumps(data).encode("utf-8"), {})
+
+    # S3 API
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfMatch=None, Range=None):
+        body, metadata = self._get(Bucket, Key, "GetObject")
+        etag = self._etag(body)
+        if IfMatch is not None and IfMatch != etag:
+            raise self._error("PreconditionFailed", "GetObject", 412)
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise self._error("304", "GetObject", 304)
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        with self.lock:
+            self.bytes_out += len(body)
+        return {"Body": io.BytesIO(body), "ETag": etag, "ContentLength": len(body), "Metadata": dict(metadata)}
+
+    def head_object(self, Bucket, Key):
+        body, metadata = self._get(Bucket, Key, "HeadObject")
+        return {"ETag": self._etag(body), "ContentLength": len(body), "Metadata": dict(metadata)}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, Metadata=None, IfMatch=None, IfNoneMatch=None):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        with self.lock:
+            self.requests += 1
+            current = self._load(Bucket, Key)
+            if IfNoneMatch == "*" and current is not None:
+                raise self._error("PreconditionFailed", "PutObject", 412)
+            if IfMatch is not None and (current is None or self._etag(current[0]) != IfMatch):
+                raise self._error("PreconditionFailed", "PutObject", 412)
+            self._store(Bucket, Key, Body, Metadata or {})
+            self.bytes_in += len(Body)
+        return {"ETag": self._etag(Body)}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.requests += 1
+            self._drop(Bucket, Key)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        with self.lock:
+            self.requests += 1
+            upload_id = f"upload-{len(self.uploads) + 1}"
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.requests += 1
+            self.uploads[UploadId][PartNumber] = Body
+            self.bytes_in += len(Body)
+        return {"ETag": self._etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self.lock:
+            self.requests += 1
+            parts = self.uploads.pop(UploadId)
+            body = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+            self._store(Bucket, Key, body, {})
+        return {"ETag": self._etag(body)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+def install_s3(fake):
+    # Points the handlers' shared lazy S3 client at the fake, so boto3 is never touched
+    from s3fetch import get_s3_client
+    get_s3_client()._client = fake
+    return fake
+
+
+# Scraper and niche API
+
+
+def make_media(username, index, rng):
+    # A reel with every field api4/api5 read, sized roughly like the scraper's payload
+    taken_at = 1_700_000_000 - index * 3600
+    return {
+        "media": {
+            "pk": f"{username}-{index}",
+            "taken_at": taken_at,
+            "like_count": rng.randint(0, 50_000),
+            "comment_count": rng.randint(0, 2_000),
+            "play_count": rng.randint(1_000, 2_000_000),
+            "has_liked": False,
+            "caption": {"text": f"Reel {index} by {username} #fitness #travel #food"},
+            "usertags": {"in": [{"user": {"username": f"{username}_friend", "is_verified": False}}]},
+            "clips_metadata": {
+                "original_sound_info": {"audio_asset_id": f"audio-{index}"},
+                "mashup_info": {"mashups_allowed": True, "non_privacy_filtered_mashups_media_count": 0}
+            },
+            "video_versions": [{"width": 720, "height": 1280, "url": f"https://cdn.example/{username}/{index}.mp4"}],
+            "video_duration": rng.uniform(5, 90),
+            "has_audio": True,
+            "user": {"is_private": False, "is_verified": False, "profile_pic_url": "", "username": username,
+                     "full_name": username.title()},
+            "hashtags": ["fitness", "travel"],
+            "can_viewer_save": True,
+            "can_viewer_reshare": True,
+            "logging_info_token": "x" * 64,
+            "organic_tracking_token": "y" * 128,
+            "image_versions2": {"candidates": [{"width": 640, "height": 1136, "url": "https://cdn.example/thumb.jpg"}] * 4}
+        }
+    }
+
+
+def scraper_payload(username, params, reels=12, following=200, seed=0):
+    # One payload that satisfies every scraper call the handlers make: the following list
+    # (api1), the follower count (api3) and the reels feed (api3/api4)
+    rng = random.Random(f"{seed}:{username}")
+    count = int(params.get("count", 50)) if params else 50
+    page = int(params.get("pagination_token", 0)) if params else 0
+    start = page * count
+    users = [{"username": f"{username}_f{i}"} for i in range(start, min(start + count, following))]
+    return {
+        "data": {
+            "users": users,
+            "edge_followed_by": {"count": rng.randint(1_000, 100_000)},
+            "items": [make_media(username, index, rng) for index in range(min(reels, count))]
+        },
+        "pagination_token": str(page + 1) if start + count < following else None
+    }
+
+
+def niche_payload(request_json):
+    # Batched requests get a verdict per creator, single requests one verdict
+    if request_json and "messages" in request_json:
+        return {"results": {message["username"]: {"match": 1} for message in request_json["messages"]}}
+    return {"match": 1}
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.content = json.dumps(payload).encode("utf-8")
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+
+class FakeSession:
+    # Answers in-process instead of over the network. GETs are scraper calls, POSTs are
+    # niche classifications; the username is taken from the query or the URL.
+    def __init__(self, reels=12, following=200):
+        self.reels = reels
+        self.following = following
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        with self.lock:
+            self.calls += 1
+        params = params or {}
+        username = params.get("username_or_id") or url.rstrip("/").rsplit("/", 1)[-1] or "creator"
+        return FakeResponse(200, scraper_payload(username, params, self.reels, self.following))
+
+    def post(self, url, json=None, timeout=None):
+        with self.lock:
+            self.calls += 1
+        return FakeResponse(200, niche_payload(json))
+
+
+def install_http(session):
+    # Every host gets the fake session through httpsession's per-host cache
+    import httpsession
+    httpsession._build_session = lambda: session
+    with httpsession._sessions_lock:
+        httpsession._sessions.clear()
+    return session
+
+
+# Canned requests and the S3 objects they read
+
+CREATORS = [f"creator{i:02d}" for i in range(20)]
+
+
+def seed_objects(fake, creators=CREATORS, reels=12):
+    from pagedarray import INDEX_STRIDE
+    from s3writer import S3JsonArrayWriter
+
+    rng = random.Random(0)
+    # Written the way api1 writes it, with the offsets index api2 pages through
+    writer = S3JsonArrayWriter(fake, "user-following", "seed/usernames.json", index_stride=INDEX_STRIDE)
+    for i in range(2000):
+        writer.append(f"seed_f{i}")
+    writer.close()
+    for username in creators:
+        items = [make_media(username, index, rng) for index in range(reels)]
+        fake.put_json("instascraper", f"{username}_reels.json", {"data": {"items": items}})
+        top = [{"username": username, "like_count": rng.randint(0, 50_000), "comment_count": rng.randint(0, 2_000),
+                "play_count": rng.randint(1_000, 2_000_000), "performance_score": rng.random()} for _ in range(5)]
+        top.sort(key=lambda video: video["performance_score"], reverse=True)
+        fake.put_json("top5videos-eachcreator", f"{username}_top5_videos.json", top)
+
+
+EVENTS = {
+    "api1": {"body": json.dumps({"username": "seed", "page_size": 50, "max_users": 200})},
+    "api2": {"body": json.dumps({"username": "seed", "offset": 500, "limit": 100})},
+    "api3": {"body": json.dumps({"usernames": CREATORS[:10], "niche": "fitness", "level": "broad",
+                                 "followercount": "1000000", "niche_batch_size": 5})},
+    "api4": {"body": json.dumps({"usernames": CREATORS[:5], "api_key": "local", "bucket_name": "instascraper"})},
+    "api5": {"body": json.dumps({"usernames": CREATORS})},
+    "api6": {"body": json.dumps({"usernames": CREATORS, "X": 10})},
+}
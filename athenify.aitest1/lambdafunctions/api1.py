@@ -1,7 +1,121 @@
+import coldstart
 import json
-import boto3
-import requests
+import metrics
+import os
+from httpsession import get_session
+from ratelimiter import get_rate_limiter
+from s3writer import S3JsonArrayWriter
+from pagedarray import INDEX_STRIDE
+from followgraph import record_snapshot
+from deadline import SKIPPED, Deadline, make_continuation_token, read_continuation_token
+from s3fetch import get_s3_client
 
+coldstart.mark_initialized()
+
+# S3 client, built on first use and kept for warm invocations
+s3 = get_s3_client()
+
+# Following-list ingestion limits, can be overridden per request with "page_size" and "max_users"
+FOLLOWING_PAGE_SIZE = int(os.environ.get("FOLLOWING_PAGE_SIZE", "50"))
+FOLLOWING_MAX_USERS = int(os.environ.get("FOLLOWING_MAX_USERS", "10000"))
+MAX_RATE_LIMITED_RETRIES = 5
+
+# Batch mode: seeds fetched concurrently, can be overridden per request with "max_workers".
+# All workers share the scraper rate limiter, so more workers never means more than the quota.
+FOLLOWING_MAX_WORKERS = int(os.environ.get("FOLLOWING_MAX_WORKERS", "4"))
+FOLLOWING_MAX_SEEDS = int(os.environ.get("FOLLOWING_MAX_SEEDS", "100"))
+
+def ingest_following(s3, username, api_url, bucket_name, page_size, max_users):
+    # Fetches one seed's following list and stores it. Returns (statusCode, result), where
+    # result is {"error": ...} on failure.
+    import requests  # Only loaded once a request got past validation
+    
+    # Create folder and stream the usernames into a JSON file in S3 page by page
+    folder_name = username
+    file_name = f"{folder_name}/usernames.json"
+    writer = S3JsonArrayWriter(s3, bucket_name, file_name, index_stride=INDEX_STRIDE)  # Indexed so api2 can serve pages with range reads
+    
+    headers = {
+        ""
+    }
+    # The list is also kept in memory: the response returns it and record_snapshot diffs it
+    # against the previous snapshot, so memory grows with the list and max_users is its cap
+    usernames = []
+    pagination_token = None
+    rate_limited = 0
+    limiter = get_rate_limiter("scraper")
+    
+    try:
+        while len(usernames) < max_users:
+            # Prepare API request for the next page
+            querystring = {"username_or_id": username, "count": str(min(page_size, max_users - len(usernames))), "version": "v2"}
+            if pagination_token:
+                querystring["pagination_token"] = pagination_token
+            
+            # Send request to Instagram API
+            limiter.acquire()  # Pace calls to the scraper API at the provider's quota
+            try:
+                response = get_session(api_url).get(api_url, headers=headers, params=querystring, timeout=10)
+            except requests.exceptions.RequestException as e:
+                writer.abort()
+                return 500, {"error": f"Error while requesting Instagram API: {str(e)}"}
+            
+            if response.status_code == 429 and rate_limited < MAX_RATE_LIMITED_RETRIES:
+                rate_limited += 1
+                metrics.incr("scraper.retries")
+                limiter.penalize(int(response.headers.get('Retry-After', 2)))
+                continue  # Retry the same page once the limiter allows it
+            
+            if response.status_code != 200:
+                # Do not replace a stored list with a partial one
+                writer.abort()
+                return 500, {"error": "Failed to fetch data from Instagram API"}
+            
+            # Extract user data from the API response
+            response_json = response.json()
+            user_data = response_json.get("data", {}).get("users", [])
+            for user in user_data[:max_users - len(usernames)]:
+                writer.append(user["username"])
+                usernames.append(user["username"])
+            
+            # Follow the API's continuation token until the list ends
+            pagination_token = response_json.get("pagination_token") or response_json.get("data", {}).get("pagination_token")
+            if not user_data or not pagination_token:
+                break
+        
+        if not usernames:
+            writer.abort()
+            return 404, {"error": "No users found in the Instagram response"}
+        
+        with metrics.span("following.store"):
+            writer.close()
+        metrics.incr("following.usernames", len(usernames))
+        print(f"Usernames successfully uploaded to {file_name} in S3 bucket {bucket_name}.")
+    except Exception as e:
+        writer.abort()
+        return 500, {"error": f"Failed to upload file to S3: {str(e)}"}
+    
+    # Version the list and record what changed since the previous run. usernames.json is already
+    # up to date, so a failure here only means the next run diffs against an older snapshot.
+    snapshot = None
+    try:
+        with metrics.span("following.snapshot"):
+            snapshot = record_snapshot(s3, bucket_name, username, usernames)
+        print(f"Following list of {username} is at version {snapshot['version']} "
+              f"({snapshot['added_count']} added, {snapshot['removed_count']} removed).")
+    except Exception as e:
+        print(f"Failed to record follow-graph snapshot for {username}: {e}")
+    
+    return 200, {
+        "successful_usernames": usernames,
+        "count": len(usernames),
+        "truncated": bool(pagination_token) and len(usernames) >= max_users,
+        "version": snapshot['version'] if snapshot else None,
+        "added_count": snapshot['added_count'] if snapshot else None,
+        "removed_count": snapshot['removed_count'] if snapshot else None
+    }
+
+@metrics.instrument("api1")
 def lambda_handler(event, context):
     # Instagram scraper API details
     api_url = "change this"
@@ -21,10 +135,27 @@ def lambda_handler(event, context):
         else:
             body = event
         
-        # Extract the required fields from the body
-        username = body['username']
-        
-    except (KeyError, json.JSONDecodeError) as e:
+        # Extract the required fields from the body: a single "username", or a batch of seeds
+        # in "usernames" (or the "continuation_token" of an earlier batch)
+        if 'continuation_token' in body:
+            seeds = read_continuation_token(body['continuation_token'])
+            username = None
+        elif 'usernames' in body:
+            seeds = body['usernames']
+            if not isinstance(seeds, list) or not seeds or len(seeds) > FOLLOWING_MAX_SEEDS:
+                raise ValueError(f"'usernames' must be a list of 1 to {FOLLOWING_MAX_SEEDS} usernames")
+            seeds = list(dict.fromkeys(seeds))  # Two workers must never write the same seed's files
+            username = None
+        else:
+            seeds = None
+            username = body['username']
+        page_size = int(body.get('page_size', FOLLOWING_PAGE_SIZE))
+        max_users = int(body.get('max_users', FOLLOWING_MAX_USERS))
+        max_workers = int(body.get('max_workers', FOLLOWING_MAX_WORKERS))
+        if page_size < 1 or max_users < 1 or max_workers < 1:
+            raise ValueError("page_size, max_users and max_workers must be at least 1")
+    
+    except (KeyError, json.JSONDecodeError, ValueError, TypeError) as e:
         print(f"Error parsing request body: {e}")
         return {
             "statusCode": 400,
@@ -39,71 +170,67 @@ def lambda_handler(event, context):
     bucket_name = "user-following"
     
     
-    if not username:
+    if seeds is None and not username:
         return {
             "statusCode": 400,
             "body": json.dumps({"error": "Username is required"})
         }
     
-    # Prepare API request
-    querystring = {"username_or_id": username, "count": "2", "version": "v2"} # Make sure to change this later
-    headers = {
-        ""
-    }
-    
-    # Send request to Instagram API
-    try:
-        response = requests.get(api_url, headers=headers, params=querystring, timeout=10)
-    except requests.exceptions.RequestException as e:
+    if seeds is None:
+        status_code, result = ingest_following(s3, username, api_url, bucket_name, page_size, max_users)
+        if status_code != 200:
+            return {
+                "statusCode": status_code,
+                "body": json.dumps(result)
+            }
         return {
-            "statusCode": 500,
-            "body": json.dumps({"error": f"Error while requesting Instagram API: {str(e)}"})
-        }
-    
-    if response.status_code != 200:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": "Failed to fetch data from Instagram API"})
-        }
-    
-    # Extract user data from the API response
-    user_data = response.json().get("data", {}).get("users", [])
-    if not user_data:
-        return {
-            "statusCode": 404,
-            "body": json.dumps({"error": "No users found in the Instagram response"})
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers": "Content-Type"
+            },
+            "body": json.dumps({
+                "message": "Usernames successfully uploaded to S3",
+                **result
+            })
         }
     
-    usernames = [user["username"] for user in user_data]
+    # Batch mode: seeds run concurrently until the Lambda deadline gets close, the rest are
+    # handed back in a continuation token
+    def ingest(seed):
+        if not isinstance(seed, str) or not seed:
+            return 400, {"error": "Username is required"}
+        try:
+            return ingest_following(s3, seed, api_url, bucket_name, page_size, max_users)
+        except Exception as e:
+            print(f"Unexpected error ingesting {seed}: {e}")
+            return 500, {"error": str(e)}
     
-    # Initialize S3 client
-    try:
-        s3 = boto3.client('s3')
-        print("S3 client initialized successfully.")
-    except Exception as e:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": f"Failed to initialize S3 client: {str(e)}"})
-        }
-    
-    # Create folder and upload JSON file to S3
-    folder_name = username
-    file_name = f"{folder_name}/usernames.json"
+    with metrics.span("following.batch"):
+        outcomes = Deadline(context).map(ingest, seeds, max_workers)
     
-    try:
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=file_name,
-            Body=json.dumps(usernames),
-            ContentType="application/json"
-        )
-        print(f"Usernames successfully uploaded to {file_name} in S3 bucket {bucket_name}.")
-    except Exception as e:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": f"Failed to upload file to S3: {str(e)}"})
-        }
+    results = []
+    deferred = []
+    for seed, outcome in zip(seeds, outcomes):
+        if outcome is SKIPPED:
+            deferred.append(seed)
+            results.append({"username": seed, "status": "deferred"})
+            continue
+        status_code, result = outcome
+        # The usernames themselves stay in S3, a batch response only carries the counts
+        result.pop("successful_usernames", None)
+        results.append({
+            "username": seed,
+            "status": "success" if status_code == 200 else "error",
+            "statusCode": status_code,
+            **result
+        })
     
+    succeeded = sum(1 for result in results if result["status"] == "success")
+    metrics.incr("seeds.succeeded", succeeded)
+    metrics.incr("seeds.failed", len(results) - succeeded - len(deferred))
+    metrics.incr("seeds.deferred", len(deferred))
+    print(f"Batch finished: {succeeded} succeeded, {len(results) - succeeded - len(deferred)} failed, {len(deferred)} deferred.")
     return {
         "statusCode": 200,
         "headers": {
@@ -111,7 +238,11 @@ def lambda_handler(event, context):
             "Access-Control-Allow-Headers": "Content-Type"
         },
         "body": json.dumps({
-            "message": "Usernames successfully uploaded to S3",
-            "successful_usernames": usernames
+            "message": "Batch processed",
+            "results": results,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded - len(deferred),
+            "deferred_count": len(deferred),
+            "continuation_token": make_continuation_token(deferred) if deferred else None
         })
     }
@@ -1,9 +1,47 @@
+import coldstart
 import json
-import boto3
+import metrics
+import os
+from s3cache import object_cache
+from followgraph import changes_since
+from pagedarray import index_key, is_stale, is_usable, read_page
+from s3fetch import get_s3_client
 
-s3 = boto3.client('s3')
+coldstart.mark_initialized()
+
+s3 = get_s3_client()  # Built on first use, so invalid requests never load boto3
 BUCKET_NAME = 'user-following'  # Replace with your actual bucket name
 
+# Page sizes for "offset"/"limit" requests, keeps big accounts under the API Gateway payload limit
+DEFAULT_PAGE_SIZE = int(os.environ.get("API2_DEFAULT_PAGE_SIZE", "1000"))
+MAX_PAGE_SIZE = int(os.environ.get("API2_MAX_PAGE_SIZE", "10000"))
+
+def load_page(file_key, offset, limit):
+    # Serves the page with a byte-range GET through the list's offsets index. Lists written
+    # before the index existed, or rewritten since it was read, fall back to the full object.
+    from botocore.exceptions import ClientError
+    
+    try:
+        index = object_cache.get_json(s3, BUCKET_NAME, index_key(file_key))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ("NoSuchKey", "404"):
+            raise
+        index = None
+    
+    if is_usable(index):
+        try:
+            return read_page(s3, BUCKET_NAME, file_key, index, offset, limit), index['count']
+        except ClientError as e:
+            if not is_stale(e):
+                raise
+            print(f"Offsets index for {file_key} is stale, reading the full list")
+    
+    metrics.incr("following.full_reads")
+    
+    usernames = object_cache.get_json(s3, BUCKET_NAME, file_key)
+    return usernames[offset:offset + limit], len(usernames)
+
+@metrics.instrument("api2")
 def lambda_handler(event, context):
     print("Lambda handler started.")
     print(f"Received event: {json.dumps(event)}")  # Log the event to debug issues with the request payload
@@ -22,8 +60,20 @@ def lambda_handler(event, context):
         
         # Extract the required fields from the body
         username = body['username']
+        # Optional: return only the usernames added/removed after this follow-graph version
+        since_version = body.get('since_version')
+        if since_version is not None:
+            since_version = int(since_version)
+            if since_version < 0:
+                raise ValueError("since_version must not be negative")
+        # Optional paging, without it the whole list is returned
+        paged = 'offset' in body or 'limit' in body
+        offset = int(body.get('offset', 0))
+        limit = min(int(body.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if offset < 0 or limit < 1:
+            raise ValueError("offset must not be negative and limit must be at least 1")
         
-    except (KeyError, json.JSONDecodeError) as e:
+    except (KeyError, json.JSONDecodeError, ValueError, TypeError) as e:
         print(f"Error parsing request body: {e}")
         return {
             "statusCode": 400,
@@ -34,12 +84,50 @@ def lambda_handler(event, context):
             "body": json.dumps({"status": "error", "message": "Invalid input format"})
         }
 
+    if since_version is not None:
+        try:
+            with metrics.span("following.changes"):
+                changes = changes_since(s3, BUCKET_NAME, username, since_version, cache=object_cache)
+        except ValueError as e:
+            print(f"Invalid since_version for user {username}: {e}")
+            return {
+                "statusCode": 400,
+                "headers": {
+                    "Access-Control-Allow-Headers": "Content-Type",
+                    "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
+                },
+                "body": json.dumps({"status": "error", "message": str(e)})
+            }
+        except Exception as e:
+            print(f"Error accessing S3: {e}")
+            return {
+                "statusCode": 500,
+                "headers": {
+                    "Access-Control-Allow-Headers": "Content-Type",
+                    "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
+                },
+                "body": json.dumps({"status": "error", "message": "Internal server error"})
+            }
+        
+        print("Lambda handler finished.")
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
+            },
+            "body": json.dumps({"status": "success", **changes})
+        }
+
     # Fetch the folder associated with the username in the S3 bucket
     try:
         file_key = f"{username}/usernames.json"  # Path to the usernames.json file in the bucket
-        response = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        usernames = json.loads(file_content)  # The file is a JSON array, so we directly load it as a list
+        if paged:
+            with metrics.span("following.page"):
+                usernames, total = load_page(file_key, offset, limit)
+        else:
+            # The file is a JSON array, served from this container's cache when its ETag is unchanged
+            usernames = object_cache.get_json(s3, BUCKET_NAME, file_key)
     
     except s3.exceptions.NoSuchKey:
         print(f"File not found for user {username}")
@@ -62,6 +150,18 @@ def lambda_handler(event, context):
             "body": json.dumps({"status": "error", "message": "Internal server error"})
         }
 
+    response_body = {
+        "status": "success",
+        "data": usernames  # Directly return the usernames array
+    }
+    if paged:
+        response_body.update({
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+            "next_offset": offset + len(usernames) if offset + len(usernames) < total else None
+        })
+
     print("Lambda handler finished.")
     return {
         "statusCode": 200,
@@ -69,8 +169,5 @@ def lambda_handler(event, context):
             "Access-Control-Allow-Headers": "Content-Type",  
             "Access-Control-Allow-Methods": "OPTIONS,POST,GET"  
         },
-        "body": json.dumps({
-            "status": "success",
-            "data": usernames  # Directly return the usernames array
-        })
+        "body": json.dumps(response_body)
     }
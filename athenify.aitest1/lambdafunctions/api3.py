@@ -1,11 +1,32 @@
+import coldstart
 import json
-import requests
 import logging
+import metrics
+import os
 import time
+from deadline import SKIPPED, Deadline, make_continuation_token, read_continuation_token
+from httpsession import get_session, request_timeout
+from jobstore import get_job_store
+from nichecache import make_cache_key, niche_cache
+from ratelimiter import get_rate_limiter
+
+coldstart.mark_initialized()
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Number of creators processed concurrently, can be overridden per request with "max_workers"
+DEFAULT_MAX_WORKERS = int(os.environ.get("API3_MAX_WORKERS", "8"))
+
+# Batched niche classification: creators packed into one LLM request ("niche_batch_size",
+# 1 disables batching) and the approximate prompt token budget for a single batch
+DEFAULT_NICHE_BATCH_SIZE = int(os.environ.get("NICHE_BATCH_SIZE", "1"))
+NICHE_BATCH_TOKEN_BUDGET = int(os.environ.get("NICHE_BATCH_TOKEN_BUDGET", "12000"))
+
+# Follower counts looked up by this container, username -> (count, fetched_at)
+PROFILE_CACHE_TTL_SECONDS = int(os.environ.get("PROFILE_CACHE_TTL_SECONDS", "3600"))
+_follower_counts = {}
+
 # Function to check if the value "1" is present anywhere in a nested dictionary or list
 def contains_one(data):
     if data is None:
@@ -20,15 +41,16 @@ def contains_one(data):
     return '1' in str(data)
     
 
-def make_request_with_retry(url, headers, params=None, max_retries=5):
+def make_request_with_retry(url, headers, params=None, max_retries=5, deadline=None):
     retry_count = 0
     backoff_time = 2  # Start with 2 seconds
+    limiter = get_rate_limiter("scraper")
 
     while retry_count < max_retries:
-        response = requests.get(url, headers=headers, params=params)
+        limiter.acquire()  # Pace calls to the scraper API at the provider's quota
+        response = get_session(url).get(url, headers=headers, params=params, timeout=request_timeout(deadline))
         
         if response.status_code == 200:
-            time.sleep(2)  # Wait for 2 seconds between successful requests
             return response
         elif response.status_code == 429:  # Rate limit error
             retry_after = response.headers.get('Retry-After')
@@ -38,18 +60,335 @@ def make_request_with_retry(url, headers, params=None, max_retries=5):
                 wait_time = backoff_time
             
             print(f"Rate limit hit. Waiting for {wait_time} seconds before retrying...")
-            time.sleep(wait_time)
+            metrics.incr("scraper.retries")
+            limiter.penalize(wait_time)  # Every caller sharing the limiter backs off
             backoff_time *= 2  # Exponentially increase the wait time
             retry_count += 1
         else:
-            # Wait for 2 seconds between requests even if the status code is not 200 or 429
-            time.sleep(4)
             return response
     
     # If all retries fail, return None
     return None
 
 
+def fetch_niche_input(username, url_base, headers, querystring, logs, deadline=None):
+    url = f"{url_base}{username}"
+    response = make_request_with_retry(url, headers, params=querystring, deadline=deadline)
+
+    if response.status_code != 200:
+        logs.append(f"Failed to retrieve data for {username}, status code: {response.status_code}")
+        return None
+
+    data = response.json()
+    
+    # Safeguard: Validate response structure
+    if not data or 'data' not in data or 'items' not in data['data']:
+        logs.append(f"No 'items' key found in the data for {username}")
+        return None
+
+    items = data['data']['items']
+    all_combined_items = []
+
+    for item in items:
+        media = item.get('media', {}) if isinstance(item.get('media'), dict) else {}
+        user = media.get('user', {}) if isinstance(media.get('user'), dict) else {}
+
+        extracted_data = {
+            "caption": media.get('caption', {}).get('text', None) if isinstance(media.get('caption'), dict) else None,
+            "username": user.get('username', None),
+            "full_name": user.get('full_name', None),
+            "text": media.get('caption', {}).get('text', None) if isinstance(media.get('caption'), dict) else None,
+            "hashtags": media.get('hashtags', []) if isinstance(media.get('hashtags'), list) else [],
+            "is_verified": user.get('is_verified', None)
+        }
+
+        all_combined_items.append(extracted_data)
+
+    # Prepare the input for the niche function
+    all_combined_items_str = [json.dumps(item) for item in all_combined_items]
+    return "".join(all_combined_items_str) if all_combined_items_str else "Return "
+
+
+def classify_niche(username, nicheinput, niche, level, logs, deadline=None):
+    # Skip the LLM call when this creator's items were already classified for this niche and level
+    cache_key = make_cache_key(username, niche, level, nicheinput)
+    cached = niche_cache.get(cache_key)
+    if cached is not None:
+        metrics.incr("niche.cache_hits")
+        return cached
+    metrics.incr("niche.calls")
+
+    nicheurl = "change this"
+    bodyniche = {
+        "model": "gpt-4o-mini",
+        "message": nicheinput,
+        "niche": niche,
+        "level": level
+    }
+
+    responseniche = get_session(nicheurl).post(nicheurl, json=bodyniche, timeout=request_timeout(deadline, "POST"))
+
+    if responseniche.status_code != 200:
+        logs.append(f"Error from niche API for {username}: {responseniche.status_code}")
+        # Allow usernames even on niche API failure, any other error gives no verdict (None)
+        if responseniche.status_code == 500 or responseniche.status_code == "500":
+            return True
+        return None
+
+    niche_result = responseniche.json()
+    passed = bool(niche_result and contains_one(niche_result))
+    niche_cache.put(cache_key, passed)
+
+    return passed
+
+
+def get_follower_count(username, headers, logs, deadline=None):
+    # Follower counts barely move between runs, so they are served from the container's
+    # profile cache when fresh instead of spending a scraper API call
+    cached = _follower_counts.get(username)
+    if cached is not None and time.time() - cached[1] <= PROFILE_CACHE_TTL_SECONDS:
+        metrics.incr("profile_cache.hits")
+        return cached[0]
+
+    url = ""
+    response = make_request_with_retry(url, headers, deadline=deadline)
+    
+    if response.status_code != 200:
+        logs.append(f"Failed to fetch data for {username}, status code: {response.status_code}")
+        return None
+
+    data = response.json()
+
+    # Safeguard: Validate follower count access
+    if not data or 'data' not in data or 'edge_followed_by' not in data['data']:
+        logs.append(f"Missing follower count data for {username}")
+        return None
+
+    follower_count = int(data['data']['edge_followed_by'].get('count', 0))
+    print(f"Username: {username}, Follower Count: {follower_count}")
+
+    _follower_counts[username] = (follower_count, time.time())
+    return follower_count
+
+
+def check_follower_count(username, headers, followercount, logs, deadline=None):
+    # None when the count could not be fetched, so there is no verdict
+    follower_count = get_follower_count(username, headers, logs, deadline)
+    return None if follower_count is None else follower_count <= int(followercount)
+
+
+def estimate_tokens(text):
+    # Rough prompt size, about 4 characters per token for English captions
+    return len(text) // 4 + 1
+
+
+def pack_niche_batches(pending, batch_size, token_budget):
+    # Greedily group (username, nicheinput) pairs into batches of at most batch_size
+    # creators and token_budget tokens. A creator over the budget gets a batch of its own.
+    batches = []
+    current = []
+    current_tokens = 0
+
+    for username, nicheinput in pending:
+        tokens = estimate_tokens(nicheinput)
+        if current and (len(current) >= batch_size or current_tokens + tokens > token_budget):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((username, nicheinput))
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def classify_niche_batch(batch, niche, level, deadline=None):
+    # Sends several creators in one request. The endpoint answers with
+    # {"results": {username: <niche result>}}; creators missing from the answer are
+    # left out of the returned verdicts so the caller can retry them one by one.
+    nichebatchurl = "change this"
+    bodyniche = {
+        "model": "gpt-4o-mini",
+        "messages": [{"username": username, "message": nicheinput} for username, nicheinput in batch],
+        "niche": niche,
+        "level": level
+    }
+
+    metrics.incr("niche.batch_calls")
+    metrics.incr("niche.batched_creators", len(batch))
+    responseniche = get_session(nichebatchurl).post(nichebatchurl, json=bodyniche,
+                                                    timeout=request_timeout(deadline, "POST"))
+
+    if responseniche.status_code != 200:
+        raise ValueError(f"status code: {responseniche.status_code}")
+
+    results = responseniche.json().get('results', {})
+    verdicts = {}
+    for username, nicheinput in batch:
+        if username in results:
+            passed = bool(results[username] and contains_one(results[username]))
+            niche_cache.put(make_cache_key(username, niche, level, nicheinput), passed)
+            verdicts[username] = passed
+    return verdicts
+
+
+def run_concurrently(func, items, max_workers, deadline):
+    # Each stage passes its own Deadline (see run_filter_plan), so a cheap stage does not make
+    # the projection for an expensive one look better than it is. Items left when the Lambda
+    # deadline gets close come back as SKIPPED.
+    return deadline.map(func, items, max_workers)
+
+
+# The stages add creators they could not get a verdict for (failed or timed out calls) to
+# `failed`. They are eliminated from this request but a resumed job retries them.
+def follower_count_stage(usernames, headers, followercount, logs, failed, max_workers, deadline):
+    def check(username):
+        try:
+            passed = check_follower_count(username, headers, followercount, logs[username], deadline)
+        except Exception as e:
+            logs[username].append(f"Error processing follower count for {username}: {str(e)}")
+            passed = None
+        if passed is None:
+            failed.add(username)
+        return bool(passed)
+
+    return [None if result is SKIPPED else result
+            for result in run_concurrently(check, usernames, max_workers, deadline)]
+
+
+def niche_stage(usernames, niche, level, url_base, headers, querystring, logs, failed, max_workers, batch_size, deadline):
+    def fetch(username):
+        try:
+            nicheinput = fetch_niche_input(username, url_base, headers, querystring, logs[username], deadline)
+        except Exception as e:
+            logs[username].append(f"Error processing username {username}: {str(e)}")
+            nicheinput = None
+        if nicheinput is None:
+            failed.add(username)
+        return nicheinput
+
+    def classify_one(username, nicheinput):
+        try:
+            passed = classify_niche(username, nicheinput, niche, level, logs[username], deadline)
+        except Exception as e:
+            logs[username].append(f"Error processing username {username}: {str(e)}")
+            passed = None
+        if passed is None:
+            failed.add(username)
+        return bool(passed)
+
+    if batch_size <= 1:
+        # Each worker fetches and classifies one creator, pipelining both calls across creators
+        def run(username):
+            nicheinput = fetch(username)
+            return nicheinput is not None and classify_one(username, nicheinput)
+
+        return [None if result is SKIPPED else result
+                for result in run_concurrently(run, usernames, max_workers, deadline)]
+
+    # Batched mode: fetch every creator first, then pack the cache misses into as few
+    # LLM requests as possible
+    niche_passed = {}
+    pending = []
+    for username, nicheinput in zip(usernames, run_concurrently(fetch, usernames, max_workers, deadline)):
+        if nicheinput is SKIPPED:
+            niche_passed[username] = None
+            continue
+        if nicheinput is None:
+            continue
+        cached = niche_cache.get(make_cache_key(username, niche, level, nicheinput))
+        if cached is not None:
+            niche_passed[username] = cached
+        else:
+            pending.append((username, nicheinput))
+
+    def classify(batch):
+        verdicts = {}
+        if len(batch) > 1:
+            try:
+                verdicts = classify_niche_batch(batch, niche, level, deadline)
+            except Exception as e:
+                print(f"Batched niche request for {len(batch)} creators failed, retrying one by one: {e}")
+
+        # Fall back to single requests for anything the batch did not answer
+        for username, nicheinput in batch:
+            if username not in verdicts:
+                verdicts[username] = classify_one(username, nicheinput)
+        return verdicts
+
+    batches = pack_niche_batches(pending, batch_size, NICHE_BATCH_TOKEN_BUDGET)
+    # Batches are timed apart from the fetches, starting from what a fetch measured
+    for batch, verdicts in zip(batches, run_concurrently(classify, batches, max_workers, deadline.next_stage())):
+        if verdicts is SKIPPED:
+            verdicts = {username: None for username, _ in batch}
+        niche_passed.update(verdicts)
+
+    return [niche_passed.get(username, False) for username in usernames]
+
+
+# Runs the filter stages cheapest first, each one only over the creators that survived
+# the previous stages. stages is a list of (name, relative_cost, predicate) where the
+# predicate maps a list of usernames and a Deadline to a list of booleans, with None for
+# creators it did not get to before the deadline. Each stage gets its own Deadline, seeded
+# with the item cost the previous stage measured scaled by their relative costs. Returns the
+# survivors, the deferred creators and how many candidates each stage eliminated.
+def run_filter_plan(usernames, stages, context=None):
+    survivors = list(usernames)
+    deferred = []
+    stage_stats = []
+    deadline = None
+    previous_cost = None
+
+    for name, cost, predicate in sorted(stages, key=lambda stage: stage[1]):
+        candidates = survivors
+        deadline = Deadline(context) if deadline is None else deadline.next_stage(cost / previous_cost)
+        previous_cost = cost
+        with metrics.span(f"stage.{name}"):
+            passed = predicate(candidates, deadline) if candidates else []
+        survivors = [username for username, ok in zip(candidates, passed) if ok]
+        stage_deferred = [username for username, ok in zip(candidates, passed) if ok is None]
+        deferred.extend(stage_deferred)
+        eliminated = len(candidates) - len(survivors) - len(stage_deferred)
+        stage_stats.append({
+            "stage": name,
+            "candidates": len(candidates),
+            "eliminated": eliminated,
+            "deferred": len(stage_deferred)
+        })
+        print(f"Stage {name}: {len(candidates)} candidates, {eliminated} eliminated, {len(stage_deferred)} deferred")
+        metrics.incr(f"stage.{name}.eliminated", eliminated)
+        metrics.incr(f"stage.{name}.deferred", len(stage_deferred))
+
+    return survivors, deferred, stage_stats
+
+
+# Stores a checkpoint for every username this invocation got a verdict for and reports the
+# job's progress. Failed usernames stay pending for a bounded number of attempts. Once nothing
+# is pending the job-wide list of successful usernames is included.
+def checkpoint_job(job_store, job_id, usernames, filtered_usernames, deferred_usernames, failed_usernames,
+                   logs, max_workers):
+    passed = set(filtered_usernames)
+    deferred = set(deferred_usernames)
+
+    def save(username):
+        if username in failed_usernames:
+            job_store.save_failed_attempt(job_id, username, {"passed": False, "logs": logs[username]})
+        else:
+            job_store.save_result(job_id, username, {"passed": username in passed, "logs": logs[username]})
+
+    run_concurrently(save, [username for username in usernames if username not in deferred], max_workers, Deadline(None))
+
+    remaining = job_store.pending_usernames(job_id)
+    job = {"job_id": job_id, "complete": not remaining, "remaining_count": len(remaining)}
+    if not remaining:
+        results = job_store.load_results(job_id)
+        job["successful_usernames"] = [username for username in job_store.load_job(job_id)['usernames']
+                                       if results.get(username, {}).get('passed')]
+    return job
+
+
+@metrics.instrument("api3")
 def lambda_handler(event, context):
     try:
         # Parse the incoming event for the request body
@@ -67,6 +406,21 @@ def lambda_handler(event, context):
             # Validate necessary fields in the request body
             if not isinstance(body, dict):
                 raise ValueError("Request body is not a valid dictionary.")
+            job_id = body.get('job_id')
+            if job_id is not None:
+                # Resume a submitted job: its stored parameters fill in anything the request
+                # leaves out, and only usernames without a checkpoint are processed
+                shard_index = body.get('shard_index', 0)
+                shard_count = body.get('shard_count', 1)
+                if not isinstance(shard_count, int) or not isinstance(shard_index, int) \
+                        or shard_count < 1 or not 0 <= shard_index < shard_count:
+                    raise ValueError("Invalid 'shard_index' or 'shard_count' field.")
+                job_store = get_job_store()
+                job = job_store.load_job(job_id)
+                body = dict(job['params'], **body)
+                body['usernames'] = job_store.pending_usernames(job_id, shard_index, shard_count)
+            elif 'continuation_token' in body:
+                body['usernames'] = read_continuation_token(body['continuation_token'])
             if 'usernames' not in body or not isinstance(body['usernames'], list):
                 raise ValueError("Missing or invalid 'usernames' field.")
             if 'niche' not in body or not isinstance(body['niche'], str):
@@ -75,6 +429,10 @@ def lambda_handler(event, context):
                 raise ValueError("Missing or invalid 'level' field.")
             if 'followercount' not in body or not isinstance(body['followercount'], str):
                 raise ValueError("Missing or invalid 'followercount' field.")
+            if 'max_workers' in body and (not isinstance(body['max_workers'], int) or body['max_workers'] < 1):
+                raise ValueError("Invalid 'max_workers' field.")
+            if 'niche_batch_size' in body and (not isinstance(body['niche_batch_size'], int) or body['niche_batch_size'] < 1):
+                raise ValueError("Invalid 'niche_batch_size' field.")
         
         except (KeyError, json.JSONDecodeError, ValueError) as e:
             print(f"Error parsing request body: {e}")
@@ -103,98 +461,47 @@ def lambda_handler(event, context):
             ""
         }
 
-        successful_usernames = []
-        logs = []
-
-        for username in usernames:
-            try:
-                url = f"{url_base}{username}"
-                response = make_request_with_retry(url, headers, params=querystring)
-
-                if response.status_code != 200:
-                    logs.append(f"Failed to retrieve data for {username}, status code: {response.status_code}")
-                    continue  # Skip to the next username if the request failed
-
-                data = response.json()
-                
-                # Safeguard: Validate response structure
-                if not data or 'data' not in data or 'items' not in data['data']:
-                    logs.append(f"No 'items' key found in the data for {username}")
-                    continue
-
-                items = data['data']['items']
-                all_combined_items = []
-
-                for item in items:
-                    media = item.get('media', {}) if isinstance(item.get('media'), dict) else {}
-                    user = media.get('user', {}) if isinstance(media.get('user'), dict) else {}
-                    music_metadata = media.get('music_metadata', {}) if isinstance(media.get('music_metadata'), dict) else {}
-
-                    extracted_data = {
-                        "caption": media.get('caption', {}).get('text', None) if isinstance(media.get('caption'), dict) else None,
-                        "username": user.get('username', None),
-                        "full_name": user.get('full_name', None),
-                        "text": media.get('caption', {}).get('text', None) if isinstance(media.get('caption'), dict) else None,
-                        "hashtags": media.get('hashtags', []) if isinstance(media.get('hashtags'), list) else [],
-                        "is_verified": user.get('is_verified', None)
-                    }
-
-                    all_combined_items.append(extracted_data)
-
-                # Prepare the input for the niche function
-                all_combined_items_str = [json.dumps(item) for item in all_combined_items]
-                nicheinput = "".join(all_combined_items_str) if all_combined_items_str else "Return "
-
-                nicheurl = "change this"
-                bodyniche = {
-                    "model": "gpt-4o-mini",
-                    "message": nicheinput,
-                    "niche": niche,
-                    "level": level
-                }
-
-                responseniche = requests.post(nicheurl, json=bodyniche)
-
-                if responseniche.status_code != 200:
-                    logs.append(f"Error from niche API for {username}: {responseniche.status_code}")
-                    if responseniche.status_code == 500 or responseniche.status_code == "500":
-                        successful_usernames.append(username)  # Allow usernames even on niche API failure
-                    continue
-
-                niche_result = responseniche.json()
-
-                if niche_result and contains_one(niche_result):
-                    successful_usernames.append(username)
-
-            except Exception as e:
-                logs.append(f"Error processing username {username}: {str(e)}")
-        
-        filtered_usernames = []
-        for username in successful_usernames:
-            try:
-                base_url = ""
-                url = ""
-                response = requests.get(url, headers=headers)
-                
-                if response.status_code != 200:
-                    logs.append(f"Failed to fetch data for {username}, status code: {response.status_code}")
-                    continue
+        max_workers = body.get('max_workers', DEFAULT_MAX_WORKERS)
+        niche_batch_size = body.get('niche_batch_size', DEFAULT_NICHE_BATCH_SIZE)
 
-                data = response.json()
+        # "submit_job" turns the request into a resumable job before any work starts, so a
+        # list too long for one invocation can be finished by later ones using the job id
+        if job_id is None and body.get('submit_job'):
+            job_store = get_job_store()
+            job_id = job_store.create_job("api3", usernames, {
+                "niche": niche,
+                "level": level,
+                "followercount": followercount,
+                "max_workers": max_workers,
+                "niche_batch_size": niche_batch_size
+            })
+            print(f"Submitted job {job_id} for {len(usernames)} usernames")
 
-                # Safeguard: Validate follower count access
-                if not data or 'data' not in data or 'edge_followed_by' not in data['data']:
-                    logs.append(f"Missing follower count data for {username}")
-                    continue
+        logs_by_username = {username: [] for username in usernames}
+        failed_usernames = set()
 
-                follower_count = int(data['data']['edge_followed_by'].get('count', 0))
-                print(f"Username: {username}, Follower Count: {follower_count}")
+        # Follower counts are one cheap scraper GET (or a cache hit), the niche check is a reels
+        # fetch plus an LLM call, so only creators under the follower limit reach the LLM
+        stages = [
+            ("follower_count", 1, lambda candidates, deadline: follower_count_stage(
+                candidates, headers, followercount, logs_by_username, failed_usernames, max_workers, deadline)),
+            ("niche", 10, lambda candidates, deadline: niche_stage(
+                candidates, niche, level, url_base, headers, querystring, logs_by_username,
+                failed_usernames, max_workers, niche_batch_size, deadline)),
+        ]
+        filtered_usernames, deferred_usernames, stage_stats = run_filter_plan(usernames, stages, context)
 
-                if follower_count <= int(followercount):
-                    filtered_usernames.append(username)
+        # Creators not reached before the deadline go back to the caller, who resubmits the
+        # same request with this token to continue the batch
+        continuation_token = make_continuation_token(deferred_usernames) if deferred_usernames else None
 
-            except Exception as e:
-                logs.append(f"Error processing follower count for {username}: {str(e)}")
+        job = None
+        if job_id is not None:
+            job = checkpoint_job(job_store, job_id, usernames, filtered_usernames, deferred_usernames,
+                                 failed_usernames, logs_by_username, max_workers)
+            if job['complete']:
+                filtered_usernames = job.pop('successful_usernames')
+        logs = [line for username in usernames for line in logs_by_username[username]]
 
         # Return the list of successful usernames with CORS headers and logs
         return {
@@ -205,6 +512,10 @@ def lambda_handler(event, context):
             },
             "body": json.dumps({
                 "successful_usernames": filtered_usernames,
+                "stage_stats": stage_stats,
+                "continuation_token": continuation_token,
+                "deferred_count": len(deferred_usernames),
+                "job": job,
                 "logs": logs
             })
         }
@@ -1,83 +1,228 @@
-import requests
+import coldstart
 import json
-import boto3
-import time
+import metrics
+import os
+from httpsession import get_session, request_timeout
+from deadline import Deadline, make_continuation_token, read_continuation_token
+from jobstore import get_job_store
+from ratelimiter import get_rate_limiter
+from reelprojection import PROJECTED_REELS_ENABLED, encode_projected_reels, projected_key, projection_metadata
+from s3fetch import get_s3_client
 
-def fetch_user_reels(usernames, api_key, bucket_name):
-    #Took out api call here
-    base_url = ""
-    headers=""
+coldstart.mark_initialized()
+
+# S3 client, built on first use and kept for warm invocations
+s3 = get_s3_client()
+
+# Reels kept per creator, reels fetched per page on a repeat scan (the window whose metrics are
+# refreshed) and the most pages fetched while looking for the high-water mark
+REELS_MAX_ITEMS = int(os.environ.get("REELS_MAX_ITEMS", "30"))
+REELS_REFRESH_WINDOW = int(os.environ.get("REELS_REFRESH_WINDOW", "12"))
+REELS_MAX_PAGES = int(os.environ.get("REELS_MAX_PAGES", "5"))
+MAX_RATE_LIMITED_RETRIES = 5
+
+def media_id(item):
+    media = item.get('media') or {}
+    return str(media.get('pk') or media.get('id') or '')
+
+def media_taken_at(item):
+    return (item.get('media') or {}).get('taken_at') or 0
 
-    # Initialize S3 client with debugging information
+def reels_state_key(username):
+    return f"{username}_reels_state.json"
+
+def load_reels_state(s3, bucket_name, username):
+    # High-water mark of the reels already stored for the creator, None on the first scan
     try:
-        s3 = boto3.client('s3')
-        print("S3 client initialized successfully.")
-    except Exception as e:
-        print("Failed to initialize S3 client.")
-        print(f"Error: {e}")
-        return {"status": "error", "message": "Failed to initialize S3 client."}
+        response = s3.get_object(Bucket=bucket_name, Key=reels_state_key(username))
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return None
 
-    results = []  # Array to hold the results for each user
+def load_stored_items(s3, bucket_name, username):
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=f"{username}_reels.json")
+        return json.loads(response['Body'].read().decode('utf-8')).get('data', {}).get('items', [])
+    except s3.exceptions.NoSuchKey:
+        return []
+
+def fetch_reels_page(url, headers, querystring, limiter, deadline=None):
+    print(f"Request URL: {url}")
+    print(f"Headers: {headers}")
+    print(f"Query Parameters: {querystring}")
     
-    for username in usernames:
-        try:
-            print(f"Fetching reels for username: {username}")
-            
-            # Make the request for each username
-            url = f"{base_url}/{username}"
-            querystring = {"count": "30"}
-            print(f"Request URL: {url}")
-            print(f"Headers: {headers}")
-            print(f"Query Parameters: {querystring}")
-            
-            response = requests.get(url, headers=headers, params=querystring)
-            print(f"Response Status Code: {response.status_code}")
-            print(f"Response Content: {response.content}")
-            
-            # Check for successful response
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Response JSON: {json.dumps(data, indent=4)}")
-                
-                # Append the result to the array
-                results.append({
-                    "username": username,
-                    "data": data
-                })
-                
-                # Save each response to a separate JSON file in /tmp directory
-                file_name = f"/tmp/{username}_reels.json"
+    for rate_limited in range(MAX_RATE_LIMITED_RETRIES + 1):
+        limiter.acquire()  # Pace calls to the scraper API at the provider's quota
+        response = get_session(url).get(url, headers=headers, params=querystring, timeout=request_timeout(deadline))
+        print(f"Response Status Code: {response.status_code}")
+        print(f"Response Content: {response.content}")
+        
+        if response.status_code != 429:
+            break
+        # Rate limit error, every caller sharing the limiter backs off before the same page is retried
+        metrics.incr("scraper.rate_limited")
+        limiter.penalize(int(response.headers.get('Retry-After', 2)))
+        if rate_limited < MAX_RATE_LIMITED_RETRIES:
+            metrics.incr("scraper.retries")
+    return response
+
+def fetch_new_reels(url, headers, limiter, state, stored_items_loader, deadline=None):
+    # Repeat scan: fetch the recent window first and only keep paginating while every item on
+    # the page is newer than the high-water mark. Fetched items replace their stored copies,
+    # which refreshes the metrics of the recent window, and older stored items are kept.
+    querystring = {"count": str(REELS_REFRESH_WINDOW)}
+    first_page = None
+    fetched = []
+
+    for page in range(REELS_MAX_PAGES):
+        response = fetch_reels_page(url, headers, querystring, limiter, deadline)
+        if response.status_code != 200:
+            if first_page is None:
+                return None, response
+            break
+        
+        page_data = response.json()
+        if first_page is None:
+            first_page = page_data
+        page_items = page_data.get('data', {}).get('items', [])
+        fetched.extend(page_items)
+        
+        if not page_items or any(media_taken_at(item) <= state['newest_taken_at'] for item in page_items):
+            break  # Reached reels that are already stored
+        pagination_token = page_data.get('pagination_token')
+        if not pagination_token:
+            break
+        querystring = {"count": str(REELS_REFRESH_WINDOW), "pagination_token": pagination_token}
+
+    merged = {}
+    for item in stored_items_loader() + fetched:
+        merged[media_id(item)] = item  # Fetched items come last and win
+    items = sorted(merged.values(), key=media_taken_at, reverse=True)[:REELS_MAX_ITEMS]
+
+    data = first_page
+    data.setdefault('data', {})['items'] = items
+    return data, response
+
+def fetch_one_user_reels(username, s3, bucket_name, limiter, base_url, headers, deadline=None):
+    try:
+        print(f"Fetching reels for username: {username}")
+        
+        # Make the request for each username
+        url = f"{base_url}/{username}"
+        state = load_reels_state(s3, bucket_name, username)
+        
+        if state is None:
+            # First scan of this creator, store the latest reels as returned
+            response = fetch_reels_page(url, headers, {"count": str(REELS_MAX_ITEMS)}, limiter, deadline)
+            data = response.json() if response.status_code == 200 else None
+            body = response.content
+        else:
+            data, response = fetch_new_reels(url, headers, limiter, state,
+                                             lambda: load_stored_items(s3, bucket_name, username), deadline)
+            body = json.dumps(data, separators=(",", ":")).encode('utf-8') if data is not None else None
+        
+        # Check for successful response
+        if data is not None:
+            result = {
+                "username": username,
+                "data": data
+            }
+
+            # Upload straight from memory, the payload is compact JSON so there is no need to
+            # stage it in /tmp
+            try:
+                uploaded = s3.put_object(
+                    Bucket=bucket_name,
+                    Key=f"{username}_reels.json",
+                    Body=body,
+                    ContentType="application/json"
+                )
+                print(f"Uploaded {username}_reels.json to S3 bucket {bucket_name}")
+            except Exception as e:
+                print(f"Failed to upload {username}_reels.json to S3.")
+                print(f"Error: {e}")
+                return result  # Keep the old high-water mark so the next scan refetches
+
+            # Also store the compact projection with only the fields api5 ranks on. It records the
+            # raw payload's ETag, api5 falls back to the raw payload when the two do not match
+            # (a failed projection write, or projections turned off).
+            if PROJECTED_REELS_ENABLED:
                 try:
-                    with open(file_name, "w") as f:
-                        json.dump(data, f, indent=4)
-                    print(f"Saved data to file: {file_name}")
+                    s3.put_object(
+                        Bucket=bucket_name,
+                        Key=projected_key(username),
+                        Body=encode_projected_reels(data),
+                        ContentType="application/json",
+                        Metadata=projection_metadata(uploaded.get('ETag'))
+                    )
+                    print(f"Uploaded {projected_key(username)} to S3 bucket {bucket_name}")
                 except Exception as e:
-                    print(f"Failed to save data to file: {file_name}")
+                    print(f"Failed to upload {projected_key(username)} to S3.")
                     print(f"Error: {e}")
-                    continue
 
-                # Upload the JSON file to S3
+            # Move the high-water mark to the newest stored reel
+            items = data.get('data', {}).get('items', [])
+            if items:
+                newest = max(items, key=media_taken_at)
                 try:
-                    s3.upload_file(file_name, bucket_name, f"{username}_reels.json")
-                    print(f"Uploaded {username}_reels.json to S3 bucket {bucket_name}")
+                    s3.put_object(
+                        Bucket=bucket_name,
+                        Key=reels_state_key(username),
+                        Body=json.dumps({"newest_id": media_id(newest), "newest_taken_at": media_taken_at(newest)}),
+                        ContentType="application/json"
+                    )
                 except Exception as e:
-                    print(f"Failed to upload {username}_reels.json to S3.")
+                    print(f"Failed to upload {reels_state_key(username)} to S3.")
                     print(f"Error: {e}")
-                
-                print(f"Successfully fetched data for {username}")
-            else:
-                print(f"Failed to fetch reels for {username}. Status code: {response.status_code}")
-                print(f"Response Content: {response.content}")
-        
-        except Exception as e:
-            print(f"Error fetching data for {username}: {e}")
-        
-        # Rate limiting: wait for 1 second before making the next API call
-        time.sleep(3)
+            
+            print(f"Successfully fetched data for {username}")
+            return result
+        else:
+            print(f"Failed to fetch reels for {username}. Status code: {response.status_code}")
+            print(f"Response Content: {response.content}")
+    
+    except Exception as e:
+        print(f"Error fetching data for {username}: {e}")
 
-    # Return the array with all user data
-    return results
+    return None
 
+def fetch_user_reels(usernames, api_key, bucket_name, deadline=None, checkpoint=None):
+    #Took out api call here
+    base_url = ""
+    headers=""
+
+    results = []  # Array to hold the results for each user
+    unprocessed = []  # Usernames not reached before the deadline
+    limiter = get_rate_limiter("scraper")
+    if deadline is None:
+        deadline = Deadline(None)
+    
+    for index, username in enumerate(usernames):
+        # Stop before the Lambda timeout, the rest is handed back as unprocessed. The first
+        # username is always fetched so a resubmitted continuation makes progress.
+        if index and not deadline.can_start():
+            unprocessed = usernames[index:]
+            print(f"Deadline approaching, leaving {len(unprocessed)} usernames unprocessed")
+            break
+
+        with deadline.track(), metrics.span("reels.creator"):
+            result = fetch_one_user_reels(username, s3, bucket_name, limiter, base_url, headers, deadline)
+
+        # Append the result to the array
+        if result is not None:
+            results.append(result)
+            metrics.incr("reels.stored")
+        else:
+            metrics.incr("reels.failed")
+
+        # Record the outcome so a resumed job skips the username, or retries it after a failure
+        if checkpoint is not None:
+            checkpoint(username, result)
+
+    # Return the array with all user data and the usernames left for a later invocation
+    return results, unprocessed
+
+@metrics.instrument("api4")
 def lambda_handler(event, context):
     print("Lambda handler started.")
     print(f"Received event: {json.dumps(event)}")  # Log the event to debug issues with the request payload
@@ -96,10 +241,26 @@ def lambda_handler(event, context):
         
         # Extract the required fields from the body
         api_key = body['api_key']
-        usernames = body['usernames']
-        bucket_name = body['bucket_name']
+        job_id = body.get('job_id')
+        if job_id is not None:
+            # Resume a submitted job, only usernames without a checkpoint are fetched. With
+            # shard_count > 1 parallel invocations split the pending usernames between them.
+            shard_index = body.get('shard_index', 0)
+            shard_count = body.get('shard_count', 1)
+            if not isinstance(shard_count, int) or not isinstance(shard_index, int) \
+                    or shard_count < 1 or not 0 <= shard_index < shard_count:
+                raise ValueError("Invalid 'shard_index' or 'shard_count' field.")
+            job_store = get_job_store()
+            bucket_name = job_store.load_job(job_id)['params']['bucket_name']
+            usernames = job_store.pending_usernames(job_id, shard_index, shard_count)
+        elif 'continuation_token' in body:
+            usernames = read_continuation_token(body['continuation_token'])
+            bucket_name = body['bucket_name']
+        else:
+            usernames = body['usernames']
+            bucket_name = body['bucket_name']
         
-    except (KeyError, json.JSONDecodeError) as e:
+    except (KeyError, json.JSONDecodeError, ValueError) as e:
         print(f"Error parsing request body: {e}")
         return {
             "statusCode": 400,
@@ -114,7 +275,7 @@ def lambda_handler(event, context):
     print(f"Usernames: {usernames}")
     print(f"S3 Bucket Name: {bucket_name}")
 
-    if not usernames:
+    if not usernames and job_id is None:
         print("No usernames provided.")
         return {
             "statusCode": 400,
@@ -125,8 +286,27 @@ def lambda_handler(event, context):
             "body": json.dumps({"status": "error", "message": "No usernames provided"})
         }
 
+    # "submit_job" makes the request resumable: progress is checkpointed per username and
+    # later invocations continue it with the returned job id
+    checkpoint = None
+    if job_id is None and body.get('submit_job'):
+        job_store = get_job_store()
+        job_id = job_store.create_job("api4", usernames, {"bucket_name": bucket_name})
+        print(f"Submitted job {job_id} for {len(usernames)} usernames")
+    if job_id is not None:
+        def checkpoint(username, result):
+            if result is not None:
+                job_store.save_result(job_id, username, {"stored": True})
+            else:
+                job_store.save_failed_attempt(job_id, username, {"stored": False})
+
     # Fetch the user reels and upload to the specified S3 bucket
-    all_user_data = fetch_user_reels(usernames, api_key, bucket_name)
+    all_user_data, unprocessed = fetch_user_reels(usernames, api_key, bucket_name, Deadline(context), checkpoint)
+
+    job = None
+    if job_id is not None:
+        remaining = job_store.pending_usernames(job_id)
+        job = {"job_id": job_id, "complete": not remaining, "remaining_count": len(remaining)}
 
     print("Lambda handler finished.")
     return {
@@ -137,6 +317,9 @@ def lambda_handler(event, context):
         },
         "body": json.dumps({
             "status": "success",
-            "data": all_user_data
+            "data": all_user_data,
+            # Resubmit the request with this token to fetch the usernames that did not fit
+            "continuation_token": make_continuation_token(unprocessed) if unprocessed else None,
+            "job": job
         })
     }
@@ -1,23 +1,27 @@
+import coldstart
+import hashlib
+import heapq
 import json
-import boto3
+import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from leaderboard import DEFAULT_INDEX, LEADERBOARD_ENABLED, index_versions, update_index, validate_index_name
+from reelprojection import PROJECTED_SCHEMA_VERSION, is_current_projection, projected_key
+from s3fetch import S3_FETCH_WORKERS, classify_error, fetch_concurrently, get_s3_client
+from scoring import CREATOR_WEIGHTS, performance_score
 
-# S3 client initialization
-s3 = boto3.client('s3')
+coldstart.mark_initialized()
+
+# S3 client initialization, deferred to the first request that needs it
+s3 = get_s3_client()
+
+# Number of videos kept per creator, can be overridden per request with "top_k"
+DEFAULT_TOP_K = 5
+
+# Bump whenever the parsing or ranking logic changes so every creator is recomputed once
+RANKING_VERSION = 2
 
 def calculate_performance_score(video):
-    weight_likes = 0.4
-    weight_comments = 0.3
-    weight_plays = 0.3
-    
-    # print(video)
-    
-    like_score = video.get('like_count', 0) * weight_likes
-    comment_score = video.get('comment_count', 0) * weight_comments
-    play_score = video.get('play_count', 0) * weight_plays
-    
-    total_score = like_score + comment_score + play_score
-    
-    return total_score
+    return performance_score(video, CREATOR_WEIGHTS)
 
 def parse_video_metadata(media_data):
     parsed_data = {}
@@ -103,24 +107,80 @@ def parse_video_metadata(media_data):
     
     return parsed_data
 
-def parse_and_rank_videos(json_data):
-    video_list = []
+def parse_and_rank_videos(json_data, top_k=DEFAULT_TOP_K):
+    # Keep a min-heap of the best top_k videos seen so far. The score only needs the three
+    # counts, so an item is fully parsed only when it actually makes it into the heap.
+    # Ties keep the earlier video, matching a stable sort.
+    heap = []
     
-    for item in json_data['data']['items']:
+    for index, item in enumerate(json_data['data']['items']):
         media_data = item.get('media', {})
         if media_data:  # Ensuring media data exists
+            score = calculate_performance_score(media_data)
+            rank = (score, -index)
+            if len(heap) >= top_k and rank <= heap[0][:2]:
+                continue
+            
             parsed_video = parse_video_metadata(media_data)
-            parsed_video['performance_score'] = calculate_performance_score(parsed_video)
-            video_list.append(parsed_video)
-    
-    # Sort videos by performance score in descending order
-    sorted_videos = sorted(video_list, key=lambda x: x['performance_score'], reverse=True)
+            parsed_video['performance_score'] = score
+            if len(heap) < top_k:
+                heapq.heappush(heap, (score, -index, parsed_video))
+            else:
+                heapq.heapreplace(heap, (score, -index, parsed_video))
     
-    # Get the top 5 performing videos
-    top_5_videos = sorted_videos[:5]
-    
-    return top_5_videos
+    # Return the top performing videos in descending order of performance score
+    return [video for _, _, video in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+
+def load_reels(source_bucket_name, username):
+    # Prefer the compact projection api4 writes at ingest, fall back to the raw scraper
+    # payload when it is missing, was written with another schema version or was projected
+    # from an older raw payload than the current one. Returns (json_data, source key, source
+    # ETag), always naming the raw payload so the up-to-date check follows it.
+    file_name = f"{username}_reels.json"
+    try:
+        response = s3.get_object(Bucket=source_bucket_name, Key=projected_key(username))
+        json_data = json.loads(response['Body'].read().decode('utf-8'))
+        if json_data.get('schema_version') != PROJECTED_SCHEMA_VERSION:
+            print(f"Ignoring projected reels for {username} with schema version {json_data.get('schema_version')}")
+        elif response.get('Metadata', {}).get('source-etag'):
+            raw_etag = s3.head_object(Bucket=source_bucket_name, Key=file_name).get('ETag', '')
+            if is_current_projection(response.get('Metadata'), raw_etag):
+                return json_data, file_name, raw_etag
+            print(f"Ignoring projected reels for {username}, the raw reels changed since")
+    except s3.exceptions.NoSuchKey:
+        pass
+
+    response = s3.get_object(Bucket=source_bucket_name, Key=file_name)
+    return json.loads(response['Body'].read().decode('utf-8')), file_name, response.get('ETag', '')
+
+def scoring_config_hash(top_k):
+    config = {"weights": CREATOR_WEIGHTS, "top_k": top_k, "ranking_version": RANKING_VERSION}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
+def current_output_metadata(source_bucket_name, destination_bucket_name, output_file_name, config_hash):
+    # The output records the source object and scoring config it was computed from. When
+    # both still match, two HEAD requests replace the GET, parse, rank and PUT. Returns the
+    # output's metadata when it is current, None when it has to be recomputed.
+    try:
+        metadata = s3.head_object(Bucket=destination_bucket_name, Key=output_file_name).get('Metadata', {})
+        if metadata.get('config-hash') != config_hash or not metadata.get('source-key'):
+            return None
+        source = s3.head_object(Bucket=source_bucket_name, Key=metadata['source-key'])
+    except Exception:
+        return None  # Missing output or source, recompute
+    if source.get('ETag', '').strip('"') != metadata.get('source-etag'):
+        return None
+    return metadata
+
+def output_version(metadata):
+    # Identifies the computation behind an output, kept with its leaderboard entry
+    return f"{metadata.get('source-etag')}:{metadata.get('config-hash')}"
+
+def load_output(destination_bucket_name, username):
+    response = s3.get_object(Bucket=destination_bucket_name, Key=f"{username}_top5_videos.json")
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+@metrics.instrument("api5")
 def lambda_handler(event, context):
     # Log the incoming event
     print(f"Received event: {json.dumps(event)}")
@@ -133,7 +193,12 @@ def lambda_handler(event, context):
             body = event
         
         usernames = body.get('usernames', [])
-    except (KeyError, json.JSONDecodeError) as e:
+        top_k = int(body.get('top_k', DEFAULT_TOP_K))
+        if top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        index_name = validate_index_name(body.get('index', DEFAULT_INDEX))
+        force = bool(body.get('force', False))  # Recompute even when the source is unchanged
+    except (KeyError, json.JSONDecodeError, ValueError, TypeError) as e:
         print(f"Error parsing request body: {e}")
         return {"status": "error", "message": "Invalid input format"}
     
@@ -145,32 +210,90 @@ def lambda_handler(event, context):
     source_bucket_name = 'instascraper'
     destination_bucket_name = 'top5videos-eachcreator'
     
-    # Process each username
-    for username in usernames:
-        try:
-            # Construct the filename based on the username
-            file_name = f"{username}_reels.json"
-            
-            # Fetch the file from the source S3 bucket
-            response = s3.get_object(Bucket=source_bucket_name, Key=file_name)
-            json_data = json.loads(response['Body'].read().decode('utf-8'))
-            
-            # Parse and rank videos
-            top_5_videos = parse_and_rank_videos(json_data)
-            
-            # Prepare the data to be stored in the destination S3 bucket
-            output_file_name = f"{username}_top5_videos.json"
-            output_data = json.dumps(top_5_videos, indent=4)
-            
-            # Upload the JSON file to the destination S3 bucket
-            s3.put_object(Bucket=destination_bucket_name, Key=output_file_name, Body=output_data)
-            
-            print(f"Successfully stored top 5 videos for {username} in {destination_bucket_name}/{output_file_name}")
+    # Failed usernames by kind: "not_found", "throttled" or "failed"
+    errors = {}
+    skipped = {}  # Usernames whose stored top videos are already current, with the output metadata
+    config_hash = scoring_config_hash(top_k)
+
+    def load(username):
+        if not force:
+            metadata = current_output_metadata(source_bucket_name, destination_bucket_name,
+                                               f"{username}_top5_videos.json", config_hash)
+            if metadata is not None:
+                return None, metadata
+        return load_reels(source_bucket_name, username), None
+
+    # Reels are fetched concurrently and ranked in completion order, the uploads of the
+    # ranked videos go out on their own pool so they overlap with the remaining reads
+    with ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS) as uploader:
+        uploads = {}
+        
+        for username, (loaded, output_metadata) in fetch_concurrently(load, usernames, errors=errors):
+            if loaded is None:
+                skipped[username] = output_metadata
+                metrics.incr("skipped_unchanged")
+                continue
             
-        except Exception as e:
-            print(f"Error processing username {username}: {e}")
+            json_data, source_key, source_etag = loaded
+            try:
+                # Parse and rank videos
+                with metrics.span("rank"):
+                    top_5_videos = parse_and_rank_videos(json_data, top_k)
+                
+                # Prepare the data to be stored in the destination S3 bucket
+                # The key keeps its historical "top5" name (api6 reads it), it holds top_k videos
+                output_file_name = f"{username}_top5_videos.json"
+                output_data = json.dumps(top_5_videos, indent=4)
+                
+                # Upload the JSON file to the destination S3 bucket
+                metadata = {"source-key": source_key, "source-etag": source_etag.strip('"'), "config-hash": config_hash}
+                future = uploader.submit(s3.put_object, Bucket=destination_bucket_name, Key=output_file_name,
+                                         Body=output_data, Metadata=metadata)
+                uploads[future] = (username, output_file_name, top_5_videos, output_version(metadata))
+                
+            except Exception as e:
+                print(f"Error processing username {username}: {e}")
+                errors.setdefault("failed", []).append(username)
+        
+        stored = {}
+        versions = {}
+        for future in as_completed(uploads):
+            username, output_file_name, top_5_videos, version = uploads[future]
+            try:
+                future.result()
+                stored[username] = top_5_videos
+                versions[username] = version
+                print(f"Successfully stored top {top_k} videos for {username} in {destination_bucket_name}/{output_file_name}")
+            except Exception as e:
+                print(f"Error storing top videos for {username}: {e}")
+                errors.setdefault(classify_error(e), []).append(username)
+    
+    # Fold the new top videos into the materialized leaderboard api6 reads from
+    if LEADERBOARD_ENABLED and (stored or skipped):
+        failed = []
+        with metrics.span("leaderboard.update"):
+            # Unchanged creators still need their current output in this index: the index may
+            # be new, or an earlier run may have failed to update its shard. Their entries are
+            # compared by version and only the ones behind are read back and folded in.
+            if skipped:
+                indexed = index_versions(s3, destination_bucket_name, index_name, list(skipped))
+                behind = [username for username, metadata in skipped.items()
+                          if indexed.get(username) != output_version(metadata)]
+                read_errors = {}
+                read_output = lambda username: load_output(destination_bucket_name, username)
+                for username, top_videos in fetch_concurrently(read_output, behind, errors=read_errors):
+                    stored[username] = top_videos
+                    versions[username] = output_version(skipped[username])
+                failed.extend(username for names in read_errors.values() for username in names)
+                metrics.incr("leaderboard.refolded", len(behind))
+            if stored:
+                failed.extend(update_index(s3, destination_bucket_name, index_name, stored, versions))
+        if failed:
+            errors["leaderboard"] = failed
     
     return {
         "status": "success",
-        "message": "Top 5 videos stored in S3 bucket for each user."
+        "message": f"Top {top_k} videos stored in S3 bucket for each user.",
+        "skipped_unchanged": len(skipped),
+        "errors": errors
     }
@@ -1,24 +1,72 @@
+import coldstart
+import heapq
+import itertools
 import json
-import boto3
-from botocore.exceptions import ClientError
+import metrics
+from leaderboard import DEFAULT_INDEX, LEADERBOARD_ENABLED, LEADERBOARD_MIN_CREATORS, read_summaries, validate_index_name
+from s3cache import object_cache
+from s3fetch import S3_FETCH_WORKERS, fetch_concurrently, get_s3_client
+from scoring import CREATOR_WEIGHTS, LEADERBOARD_WEIGHTS, performance_score
 
-# S3 client initialization
-s3 = boto3.client('s3')
+coldstart.mark_initialized()
+
+# S3 client initialization, deferred to the first request that needs it
+s3 = get_s3_client()
 
 def calculate_performance_score(video):
-    weight_likes = 0.65
-    weight_comments = 0.3
-    weight_plays = 0.05
-    
-    like_score = video.get('like_count', 0) * weight_likes
-    comment_score = video.get('comment_count', 0) * weight_comments
-    play_score = video.get('play_count', 0) * weight_plays
-    print(like_score)
-    print(comment_score)
-    total_score = like_score + comment_score + play_score
-    
-    return total_score
+    return performance_score(video, LEADERBOARD_WEIGHTS)
+
+def scored_videos(username, json_data):
+    for video in json_data:
+        video = dict(video)  # The decoded files are shared through the object cache
+        video['username'] = username  # Preserve the username in the video data
+        video['performance_score'] = calculate_performance_score(video)
+        yield video
+
+def select_top_videos(runs, X):
+    # Each run is one creator's videos. api5 stores them sorted by its own score, so when
+    # both stages use the same weights the runs can be merged lazily and the merge stops
+    # after X videos. Otherwise the stored order means nothing here and a bounded heap
+    # keeps the best X while streaming through every video.
+    if LEADERBOARD_WEIGHTS == CREATOR_WEIGHTS:
+        merged = heapq.merge(*runs, key=lambda x: x['performance_score'], reverse=True)
+        return list(itertools.islice(merged, X))
+    return heapq.nlargest(X, itertools.chain.from_iterable(runs), key=lambda x: x['performance_score'])
+
+def read_best_creators(load, summaries, videos_by_username, X, errors):
+    # Reads the files of the indexed creators best first, S3_FETCH_WORKERS at a time, and
+    # stops once the next creator's best video scores below the X-th best video read so far:
+    # none of the remaining creators can place a video in the top X
+    def top_score(username):
+        score = summaries[username]['top_score']
+        return float('-inf') if score is None else score
+
+    best = []  # Min-heap of the X best scores read so far
+
+    def add(videos):
+        for video in videos:
+            score = calculate_performance_score(video)
+            if len(best) < X:
+                heapq.heappush(best, score)
+            elif X > 0 and score > best[0]:
+                heapq.heapreplace(best, score)
+
+    for videos in videos_by_username.values():
+        add(videos)
 
+    candidates = sorted(summaries, key=top_score, reverse=True)
+    position = 0
+    while position < len(candidates):
+        if len(best) >= X and (not best or best[0] > top_score(candidates[position])):
+            metrics.incr("creators.pruned", len(candidates) - position)
+            break
+        chunk = candidates[position:position + S3_FETCH_WORKERS]
+        position += len(chunk)
+        for username, videos in fetch_concurrently(load, chunk, errors=errors):
+            videos_by_username[username] = videos
+            add(videos)
+
+@metrics.instrument("api6")
 def lambda_handler(event, context):
     # Log the incoming event
     print(f"Received event: {json.dumps(event)}")
@@ -32,6 +80,7 @@ def lambda_handler(event, context):
         
         usernames = body.get('usernames', [])
         X = int(body.get('X', 5))  # Default to 5 if X is not provided
+        index_name = validate_index_name(body.get('index', DEFAULT_INDEX))
         
     except (KeyError, json.JSONDecodeError, ValueError) as e:
         print(f"Error parsing request body: {e}")
@@ -41,47 +90,52 @@ def lambda_handler(event, context):
         print("No usernames provided.")
         return {"status": "error", "message": "No usernames provided"}
     
-    # Ensure X does not exceed 5 * len(usernames)
-    max_videos = 5 * len(usernames)
+    # S3 Bucket name where api5 stores each creator's top videos (top_k of them, 5 by default)
+    bucket_name = 'top5videos-eachcreator'
+    
+    def load(username):
+        # Fetch the file from the S3 bucket, or revalidate the copy cached by this container
+        return object_cache.get_json(s3, bucket_name, f"{username}_top5_videos.json")
+
+    # Failed usernames by kind: "not_found", "throttled" or "failed"
+    errors = {}
+    summaries = {}
+    if LEADERBOARD_ENABLED and len(usernames) >= LEADERBOARD_MIN_CREATORS:
+        # Score summaries from the materialized leaderboard shards
+        with metrics.span("leaderboard.read"):
+            summaries = read_summaries(s3, bucket_name, index_name, usernames, object_cache)
+    
+    # Creators the leaderboard does not know yet are read from their own files
+    missing = [username for username in usernames if username not in summaries]
+    with metrics.span("creators.read"):
+        videos_by_username = dict(fetch_concurrently(load, missing, errors=errors))
+    
+    # Ensure X does not exceed 5 videos per creator, or the videos actually stored when api5
+    # ran with a larger top_k
+    stored_count = sum(len(videos) for videos in videos_by_username.values()) \
+        + sum(summary['video_count'] for summary in summaries.values())
+    max_videos = max(5 * len(usernames), stored_count)
     if X > max_videos:
         print(f"X exceeds the allowed maximum: {X} > {max_videos}")
         return {"status": "error", "message": f"X cannot exceed {max_videos}"}
     
-    # S3 Bucket name where the top 5 videos JSON files are stored
-    bucket_name = 'top5videos-eachcreator'
-    
-    all_videos = []
-
-    # Process each username
-    for username in usernames:
-        try:
-            # Construct the filename based on the username
-            file_name = f"{username}_top5_videos.json"
-            
-            # Fetch the file from the S3 bucket
-            response = s3.get_object(Bucket=bucket_name, Key=file_name)
-            json_data = json.loads(response['Body'].read().decode('utf-8'))
-            
-            # Append videos to the all_videos list
-            for video in json_data:
-                video['username'] = username  # Preserve the username in the video data
-                video['performance_score'] = calculate_performance_score(video)
-                all_videos.append(video)
-            
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                print(f"File not found for username {username}: {file_name}")
-            else:
-                print(f"Error processing username {username}: {e}")
+    # Only the indexed creators that can still make the top X are read
+    with metrics.span("creators.read"):
+        read_best_creators(load, summaries, videos_by_username, X, errors)
+    metrics.incr("creators.from_files", len(videos_by_username))
     
-    # Sort all videos by performance score in descending order
-    sorted_videos = sorted(all_videos, key=lambda x: x['performance_score'], reverse=True)
+    # Keep each creator's videos as one run, scored lazily while they are selected. Runs
+    # follow the request order so ties break the same way whatever order the reads finished in.
+    runs = [scored_videos(username, videos_by_username[username])
+            for username in usernames if username in videos_by_username]
     
-    # Get the top X videos
-    top_videos = sorted_videos[:X]
+    # Get the top X videos in descending order of performance score
+    with metrics.span("select"):
+        top_videos = select_top_videos(runs, X)
     
     # Return the sorted top X videos
     return {
         "status": "success",
-        "data": top_videos
+        "data": top_videos,
+        "errors": errors
     }
@@ -0,0 +1,31 @@
+import os
+import time
+
+# Handlers import this module first, so the clock covers their whole import graph. The init
+# time is logged once per container, on its first invocation, against COLD_START_BUDGET_MS.
+COLD_START_BUDGET_MS = float(os.environ.get("COLD_START_BUDGET_MS", "300"))
+
+_started = time.perf_counter()
+_init_ms = None
+_reported = False
+
+
+def mark_initialized():
+    # Called at the end of the handler module's imports. Returns the init time in ms.
+    global _init_ms
+    if _init_ms is None:
+        _init_ms = (time.perf_counter() - _started) * 1000
+    return _init_ms
+
+
+def report(handler_name):
+    # Called at the start of every invocation. Returns the init time in ms on the cold
+    # invocation and None on warm ones.
+    global _reported
+    if _reported:
+        return None
+    _reported = True
+    init_ms = mark_initialized()
+    status = "over budget" if init_ms > COLD_START_BUDGET_MS else "within budget"
+    print(f"Cold start: {handler_name} initialized in {init_ms:.1f} ms ({status}, budget {COLD_START_BUDGET_MS:.0f} ms)")
+    return init_ms
@@ -0,0 +1,112 @@
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+# Time kept back for building and returning the response, and the cost assumed for an
+# item before any item of the batch has finished
+SAFETY_MARGIN_MS = int(os.environ.get("DEADLINE_SAFETY_MARGIN_MS", "3000"))
+INITIAL_ITEM_COST_MS = int(os.environ.get("DEADLINE_INITIAL_ITEM_COST_MS", "5000"))
+
+# Placeholder result for items that were not dispatched because the deadline was near
+SKIPPED = object()
+
+
+class Deadline:
+    def __init__(self, context, safety_margin_ms=SAFETY_MARGIN_MS, initial_item_cost_ms=INITIAL_ITEM_COST_MS):
+        self.context = context
+        self.safety_margin_ms = safety_margin_ms
+        self.initial_item_cost_ms = initial_item_cost_ms
+        self.completed = 0
+        self.total_ms = 0.0
+        self.lock = threading.Lock()
+
+    def remaining_ms(self):
+        # Without a Lambda context (local runs, tests) there is no deadline
+        if self.context is None or not hasattr(self.context, 'get_remaining_time_in_millis'):
+            return float('inf')
+        return self.context.get_remaining_time_in_millis()
+
+    def projected_item_ms(self):
+        with self.lock:
+            if self.completed == 0:
+                return self.initial_item_cost_ms
+            return self.total_ms / self.completed
+
+    def can_start(self):
+        # Only start another item if it is expected to finish before the margin
+        return self.remaining_ms() - self.safety_margin_ms > self.projected_item_ms()
+
+    def next_stage(self, cost_ratio=1.0):
+        # A Deadline for a later stage of the same invocation. Once this one measured item
+        # costs, the new one starts from them (scaled by how much more a later item costs)
+        # instead of the pessimistic initial estimate.
+        initial_item_cost_ms = self.initial_item_cost_ms
+        with self.lock:
+            if self.completed:
+                initial_item_cost_ms = self.total_ms / self.completed * cost_ratio
+        return Deadline(self.context, self.safety_margin_ms, initial_item_cost_ms)
+
+    @contextmanager
+    def track(self):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.completed += 1
+                self.total_ms += elapsed_ms
+
+    def map(self, func, items, max_workers=1):
+        # Like executor.map, but stops dispatching once the projected item cost no longer fits
+        # in the remaining time. Items that were never started come back as SKIPPED. The first
+        # item is always started, so every call makes progress and a caller following the
+        # continuation of the skipped items cannot be handed the same items forever.
+        results = [SKIPPED] * len(items)
+
+        def run(index):
+            with self.track():
+                results[index] = func(items[index])
+
+        if max_workers <= 1 or len(items) <= 1:
+            for index in range(len(items)):
+                if index and not self.can_start():
+                    break
+                run(index)
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            in_flight = set()
+            for index in range(len(items)):
+                if len(in_flight) >= max_workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                if index and not self.can_start():
+                    break
+                in_flight.add(executor.submit(run, index))
+            for future in in_flight:
+                future.result()
+
+        return results
+
+
+def make_continuation_token(usernames):
+    # Opaque token handed back to the caller for the usernames that were not processed
+    raw = json.dumps({"usernames": usernames}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def read_continuation_token(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+        usernames = data["usernames"]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError("Invalid 'continuation_token' field.")
+    if not isinstance(usernames, list):
+        raise ValueError("Invalid 'continuation_token' field.")
+    return usernames
@@ -0,0 +1,177 @@
+import json
+import os
+import time
+import uuid
+
+# Versioned follow-graph snapshots. Next to {username}/usernames.json (always the latest
+# list) api1 keeps a manifest, one snapshot per version and one delta per version with the
+# usernames added and removed since the previous one, so later stages can work on new follows
+# only. Deltas are small and kept for good, old snapshots are pruned.
+FOLLOW_SNAPSHOT_RETENTION = max(1, int(os.environ.get("FOLLOW_SNAPSHOT_RETENTION", "10")))
+FOLLOW_GRAPH_SCHEMA_VERSION = 1
+
+
+def manifest_key(username):
+    return f"{username}/following_manifest.json"
+
+
+def snapshot_key(username, version, run_id=None):
+    suffix = f"-{run_id}" if run_id else ""
+    return f"{username}/snapshots/v{version:06d}{suffix}.json"
+
+
+def delta_key(username, version, run_id=None):
+    suffix = f"-{run_id}" if run_id else ""
+    return f"{username}/deltas/v{version:06d}{suffix}.json"
+
+
+def _entry_keys(username, entry):
+    # Entries written before snapshots got run-unique keys point at the plain ones
+    return (entry.get('snapshot_key') or snapshot_key(username, entry['version']),
+            entry.get('delta_key') or delta_key(username, entry['version']))
+
+
+def _is_not_found(e):
+    return e.response.get('Error', {}).get('Code') in ("NoSuchKey", "404")
+
+
+def _read_json(s3, bucket, key):
+    # Returns (etag, decoded object), or (None, None) when the object does not exist
+    from botocore.exceptions import ClientError
+
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if _is_not_found(e):
+            return None, None
+        raise
+    return response.get('ETag'), json.loads(response['Body'].read().decode('utf-8'))
+
+
+def _put_json(s3, bucket, key, data, **kwargs):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(data, separators=(",", ":")),
+        ContentType="application/json",
+        **kwargs
+    )
+
+
+def load_manifest(s3, bucket, username):
+    _, manifest = _read_json(s3, bucket, manifest_key(username))
+    if manifest is None or manifest.get('schema_version') != FOLLOW_GRAPH_SCHEMA_VERSION:
+        return {"schema_version": FOLLOW_GRAPH_SCHEMA_VERSION, "current_version": 0, "versions": []}
+    return manifest
+
+
+def diff_usernames(previous, current):
+    previous_set = set(previous)
+    current_set = set(current)
+    added = [username for username in current if username not in previous_set]
+    removed = [username for username in previous if username not in current_set]
+    return added, removed
+
+
+def record_snapshot(s3, bucket, username, usernames):
+    # Called once {username}/usernames.json holds the new list. Diffs it against the latest
+    # snapshot and, when something changed, writes the snapshot and delta for a new version
+    # under keys unique to this run, then commits the manifest entry pointing at them with a
+    # conditional PUT. Of two concurrent runs only one commits its version; the other gets a
+    # ClientError and its objects were never referenced, so committed history is untouched.
+    # Returns the manifest entry of the current version, plus the added/removed usernames.
+    etag, manifest = _read_json(s3, bucket, manifest_key(username))
+    if manifest is None or manifest.get('schema_version') != FOLLOW_GRAPH_SCHEMA_VERSION:
+        manifest = {"schema_version": FOLLOW_GRAPH_SCHEMA_VERSION, "current_version": 0, "versions": []}
+
+    previous_version = manifest['current_version']
+    previous = []
+    if previous_version:
+        _, previous = _read_json(s3, bucket, _entry_keys(username, manifest['versions'][-1])[0])
+        if previous is None:
+            raise ValueError(f"Snapshot v{previous_version} of {username} is missing")
+
+    added, removed = diff_usernames(previous, usernames)
+    if previous_version and not added and not removed:
+        return dict(manifest['versions'][-1], added=[], removed=[])
+
+    version = previous_version + 1
+    created_at = time.time()
+    run_id = uuid.uuid4().hex[:12]
+    new_snapshot_key = snapshot_key(username, version, run_id)
+    new_delta_key = delta_key(username, version, run_id)
+    _put_json(s3, bucket, new_snapshot_key, usernames)
+    _put_json(s3, bucket, new_delta_key, {
+        "version": version,
+        "previous_version": previous_version,
+        "created_at": created_at,
+        "added": added,
+        "removed": removed
+    })
+
+    entry = {
+        "version": version,
+        "created_at": created_at,
+        "count": len(usernames),
+        "added_count": len(added),
+        "removed_count": len(removed),
+        "snapshot_key": new_snapshot_key,
+        "delta_key": new_delta_key
+    }
+    manifest['current_version'] = version
+    manifest['versions'].append(entry)
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        _put_json(s3, bucket, manifest_key(username), manifest, **condition)
+    except Exception:
+        # Lost the race (or the write failed), the objects of this run are unreferenced
+        for key in (new_snapshot_key, new_delta_key):
+            try:
+                s3.delete_object(Bucket=bucket, Key=key)
+            except Exception as e:
+                print(f"Failed to delete uncommitted {key}: {e}")
+        raise
+
+    # Best effort, the deltas alone are enough to answer "changes since version N"
+    old_version = version - FOLLOW_SNAPSHOT_RETENTION
+    old_entry = next((v for v in manifest['versions'] if v['version'] == old_version), None)
+    if old_entry is not None:
+        try:
+            s3.delete_object(Bucket=bucket, Key=_entry_keys(username, old_entry)[0])
+        except Exception as e:
+            print(f"Failed to prune snapshot v{old_version} of {username}: {e}")
+
+    return dict(entry, added=added, removed=removed)
+
+
+def changes_since(s3, bucket, username, since_version, cache=None):
+    # Folds the deltas after since_version into the net change up to the current version.
+    # A username added and then removed again (or the other way round) cancels out.
+    # Deltas never change once written, so they are read through the S3 object cache when one
+    # is given. Raises ValueError for a version newer than the current one.
+    manifest = load_manifest(s3, bucket, username)
+    current_version = manifest['current_version']
+    if since_version > current_version:
+        raise ValueError(f"Unknown version {since_version}, current version is {current_version}")
+
+    entries = {entry['version']: entry for entry in manifest['versions']}
+    added = {}
+    removed = {}
+    for version in range(since_version + 1, current_version + 1):
+        key = _entry_keys(username, entries.get(version, {"version": version}))[1]
+        delta = cache.get_json(s3, bucket, key) if cache is not None else _read_json(s3, bucket, key)[1]
+        if delta is None:
+            raise ValueError(f"Delta v{version} of {username} is missing")
+        for name in delta['added']:
+            if removed.pop(name, None) is None:
+                added[name] = True
+        for name in delta['removed']:
+            if added.pop(name, None) is None:
+                removed[name] = True
+
+    return {
+        "since_version": since_version,
+        "version": current_version,
+        "added": list(added),
+        "removed": list(removed)
+    }
@@ -0,0 +1,87 @@
+import os
+import threading
+from urllib.parse import urlparse
+
+import metrics
+
+# Connection pool sizing for each upstream host. pool_maxsize should be at least the
+# number of worker threads that talk to the same host (see api3 max_workers).
+POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "4"))
+POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "16"))
+
+# Timeout in seconds for one attempt of an upstream call, and the floor it is never shrunk
+# below when a Lambda deadline is close (see request_timeout)
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("HTTP_REQUEST_TIMEOUT_SECONDS", "10"))
+MIN_REQUEST_TIMEOUT_SECONDS = 0.5
+READ_RETRIES = 2
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _build_session():
+    # requests is imported here rather than at module scope so handlers that reject a
+    # request during validation never load it.
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Only connection problems and gateway errors are retried here. 429s are left to the
+    # callers, which back off through the shared rate limiter, and POSTs are never retried
+    # so a niche classification is not paid for twice.
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=READ_RETRIES,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(_record_response)
+    return session
+
+
+def _record_response(response, *args, **kwargs):
+    # One "http.GET" / "http.POST" span per request, timed by requests itself, plus status,
+    # retry and byte counters for the invocation's metrics line
+    method = response.request.method
+    metrics.record(f"http.{method}", response.elapsed.total_seconds() * 1000)
+    metrics.incr(f"http.{method}.status_{response.status_code}")
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        metrics.incr("http.retries", len(retries.history))
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        metrics.incr("http.bytes_in", int(length))
+    if response.request.body:
+        metrics.incr("http.bytes_out", len(response.request.body))
+
+
+def request_timeout(deadline=None, method="GET"):
+    # Timeout for one attempt of a call. With a deadline every attempt the adapter may make
+    # (GETs are retried on read errors, POSTs never) has to give up before the safety margin,
+    # so a stalled upstream cannot keep a worker running until Lambda kills the invocation.
+    if deadline is None:
+        return REQUEST_TIMEOUT_SECONDS
+    attempts = READ_RETRIES + 1 if method == "GET" else 1
+    budget_seconds = (deadline.remaining_ms() - deadline.safety_margin_ms) / 1000 / attempts
+    return max(MIN_REQUEST_TIMEOUT_SECONDS, min(REQUEST_TIMEOUT_SECONDS, budget_seconds))
+
+
+def get_session(url):
+    # One keep-alive session per upstream host, kept at module scope so warm Lambda
+    # invocations reuse the open TCP/TLS connections
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _build_session()
+            _sessions[host] = session
+        return session
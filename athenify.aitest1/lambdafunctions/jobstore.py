@@ -0,0 +1,152 @@
+import json
+import os
+import re
+import time
+import uuid
+from urllib.parse import quote, unquote
+
+from s3fetch import get_s3_client
+
+# Jobs are checkpointed to S3 when JOB_STORE_BUCKET is set, otherwise to a local directory
+# (handy for local runs, /tmp is the only writable path inside Lambda)
+JOB_STORE_BUCKET = os.environ.get("JOB_STORE_BUCKET")
+JOB_STORE_PREFIX = os.environ.get("JOB_STORE_PREFIX", "jobs/")
+JOB_STORE_DIR = os.environ.get("JOB_STORE_DIR", "/tmp/athenify-jobs")
+
+# Invocations that may fail a username (scraper errors, timeouts) before it is checkpointed
+# as failed for good, so a job always completes
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _job_prefix(job_id):
+    # Job ids come from requests, only the ids create_job hands out are accepted so they can
+    # never point outside the job store
+    if not isinstance(job_id, str) or not JOB_ID_PATTERN.match(job_id):
+        raise ValueError("Invalid 'job_id' field.")
+    return f"{job_id}/"
+
+
+def _username_name(username):
+    # Usernames are percent-encoded in keys, so "/" or ".." in one stays a single file name
+    return quote(str(username), safe="")
+
+
+# Layout, the same for both backends (usernames percent-encoded):
+#   {prefix}{job_id}/job.json                  usernames and request parameters
+#   {prefix}{job_id}/results/{username}.json   one checkpoint per finished username
+#   {prefix}{job_id}/attempts/{username}.json  failed attempts of a username still pending
+# Every username has its own object, so parallel invocations working on the same job never
+# overwrite each other's progress.
+class JobStore:
+    def create_job(self, kind, usernames, params):
+        job_id = uuid.uuid4().hex
+        self._write(f"{_job_prefix(job_id)}job.json", {
+            "job_id": job_id,
+            "kind": kind,
+            "usernames": usernames,
+            "params": params,
+            "created_at": time.time()
+        })
+        return job_id
+
+    def load_job(self, job_id):
+        job = self._read(f"{_job_prefix(job_id)}job.json")
+        if job is None:
+            raise ValueError(f"Unknown job {job_id}")
+        return job
+
+    def save_result(self, job_id, username, result):
+        self._write(f"{_job_prefix(job_id)}results/{_username_name(username)}.json", result)
+
+    def save_failed_attempt(self, job_id, username, result, max_attempts=JOB_MAX_ATTEMPTS):
+        # A failed username stays pending so a later invocation retries it, until it has
+        # failed max_attempts times and `result` is checkpointed as its final outcome.
+        # Returns the number of attempts so far.
+        attempts_key = f"{_job_prefix(job_id)}attempts/{_username_name(username)}.json"
+        attempts = (self._read(attempts_key) or {}).get("attempts", 0) + 1
+        if attempts >= max_attempts:
+            self.save_result(job_id, username, dict(result, attempts=attempts))
+        else:
+            self._write(attempts_key, {"attempts": attempts})
+        return attempts
+
+    def completed_usernames(self, job_id):
+        return set(unquote(name[:-len(".json")]) for name in self._list(f"{_job_prefix(job_id)}results/")
+                   if name.endswith(".json"))
+
+    def load_results(self, job_id):
+        return {username: self._read(f"{_job_prefix(job_id)}results/{_username_name(username)}.json")
+                for username in self.completed_usernames(job_id)}
+
+    def pending_usernames(self, job_id, shard_index=0, shard_count=1):
+        # Usernames without a checkpoint. With shard_count > 1 each parallel invocation only
+        # takes the usernames whose position in the job falls in its shard.
+        job = self.load_job(job_id)
+        completed = self.completed_usernames(job_id)
+        return [username for index, username in enumerate(job["usernames"])
+                if index % shard_count == shard_index and str(username) not in completed]
+
+
+class S3JobStore(JobStore):
+    def __init__(self, bucket, prefix=JOB_STORE_PREFIX):
+        self.s3 = get_s3_client()
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _write(self, key, data):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{key}",
+            Body=json.dumps(data),
+            ContentType="application/json"
+        )
+
+    def _read(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def _list(self, key_prefix):
+        names = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{key_prefix}"):
+            for item in page.get('Contents', []):
+                names.append(item['Key'][len(self.prefix) + len(key_prefix):])
+        return names
+
+
+class LocalJobStore(JobStore):
+    def __init__(self, directory=JOB_STORE_DIR):
+        self.directory = directory
+
+    def _write(self, key, data):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a half-written checkpoint is never read back
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.directory, key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _list(self, key_prefix):
+        try:
+            return os.listdir(os.path.join(self.directory, key_prefix))
+        except FileNotFoundError:
+            return []
+
+
+def get_job_store():
+    if JOB_STORE_BUCKET:
+        return S3JobStore(JOB_STORE_BUCKET)
+    return LocalJobStore()
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from s3fetch import fetch_concurrently
+from scoring import LEADERBOARD_WEIGHTS, performance_score
+
+# Materialized leaderboard: a score summary of every creator's current top videos, grouped
+# into a few shard objects per index (one index per niche or creator set, "all" by default).
+# api5 updates it whenever it writes a creator's top videos. Entries are kept small (about
+# 100 bytes) so shards stay cheap to read as the index grows: api6 uses the best score of
+# each creator to read only the files of creators that can still make its top X.
+LEADERBOARD_ENABLED = os.environ.get("LEADERBOARD_ENABLED", "true").lower() == "true"
+LEADERBOARD_SHARDS = int(os.environ.get("LEADERBOARD_SHARDS", "16"))
+LEADERBOARD_PREFIX = os.environ.get("LEADERBOARD_PREFIX", "leaderboard/")
+# Requests for fewer creators than this skip the index, a few per-creator files are cheaper
+# than the shards they hash to
+LEADERBOARD_MIN_CREATORS = int(os.environ.get("LEADERBOARD_MIN_CREATORS", "32"))
+DEFAULT_INDEX = "all"
+LEADERBOARD_SCHEMA_VERSION = 2
+
+_INDEX_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def validate_index_name(index_name):
+    if not isinstance(index_name, str) or not _INDEX_NAME.match(index_name):
+        raise ValueError("Invalid 'index' field.")
+    return index_name
+
+
+def shard_for(username, shards=LEADERBOARD_SHARDS):
+    return int(hashlib.md5(username.encode("utf-8")).hexdigest(), 16) % shards
+
+
+def shard_key(index_name, shard):
+    return f"{LEADERBOARD_PREFIX}{index_name}/shard-{shard:03d}.json"
+
+
+def _group_by_shard(usernames):
+    shards = {}
+    for username in usernames:
+        shards.setdefault(shard_for(username), []).append(username)
+    return shards
+
+
+def _is_not_found(e):
+    return e.response.get('Error', {}).get('Code') in ("NoSuchKey", "404")
+
+
+def _empty_shard():
+    return {"schema_version": LEADERBOARD_SCHEMA_VERSION, "creators": {}}
+
+
+def _read_shard(s3, bucket, key):
+    from botocore.exceptions import ClientError
+
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if _is_not_found(e):
+            return None, _empty_shard()
+        raise
+    return response.get('ETag'), json.loads(response['Body'].read().decode('utf-8'))
+
+
+def summarize(videos):
+    # The index entry of one creator. top_score is the best score api6 ranks with, so api6
+    # can skip creators whose best video cannot make its top X.
+    return {
+        "top_score": max((performance_score(video, LEADERBOARD_WEIGHTS) for video in videos), default=None),
+        "video_count": len(videos)
+    }
+
+
+def update_index(s3, bucket, index_name, top_videos_by_username, versions=None, max_attempts=5):
+    # Merges the summaries of the creators' new top videos into their shards. Each shard is
+    # rewritten with a conditional PUT on the ETag it was read with, so concurrent api5 runs
+    # retry instead of overwriting each other. versions maps usernames to the version of the
+    # output their videos come from, kept in the entry for index_versions. Returns the
+    # usernames whose shard could not be updated.
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    failed = []
+
+    for shard, usernames in _group_by_shard(top_videos_by_username).items():
+        key = shard_key(index_name, shard)
+        for attempt in range(max_attempts):
+            try:
+                etag, data = _read_shard(s3, bucket, key)
+                if data.get('schema_version') != LEADERBOARD_SCHEMA_VERSION:
+                    data = _empty_shard()
+
+                for username in usernames:
+                    data['creators'][username] = dict(
+                        summarize(top_videos_by_username[username]),
+                        updated_at=time.time(),
+                        version=(versions or {}).get(username)
+                    )
+
+                condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+                s3.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=json.dumps(data, separators=(",", ":")),
+                    ContentType="application/json",
+                    **condition
+                )
+                break
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409") and attempt < max_attempts - 1:
+                    continue  # Another writer got there first, re-read the shard and merge again
+                print(f"Failed to update leaderboard shard {key}: {e}")
+                failed.extend(usernames)
+                break
+            except BotoCoreError as e:
+                # Raised client side, e.g. ParamValidationError from a botocore too old to
+                # know the IfMatch / IfNoneMatch parameters of PutObject
+                print(f"Failed to update leaderboard shard {key}: {e}")
+                failed.extend(usernames)
+                break
+
+    return failed
+
+
+def _read_entries(s3, bucket, index_name, usernames, cache=None):
+    # Returns {username: index entry} for the requested creators found in the index. Only the
+    # shards those creators hash to are read, through the S3 object cache when one is given.
+    # Missing creators are simply left out.
+    from botocore.exceptions import ClientError
+
+    wanted = _group_by_shard(usernames)
+
+    def load(shard):
+        key = shard_key(index_name, shard)
+        if cache is None:
+            _, data = _read_shard(s3, bucket, key)
+            return data
+        try:
+            return cache.get_json(s3, bucket, key)
+        except ClientError as e:
+            if _is_not_found(e):
+                return _empty_shard()
+            raise
+
+    shard_errors = {}
+    entries = {}
+    for shard, data in fetch_concurrently(load, list(wanted), errors=shard_errors):
+        if data.get('schema_version') != LEADERBOARD_SCHEMA_VERSION:
+            continue
+        creators = data.get('creators', {})
+        for username in wanted[shard]:
+            if username in creators:
+                entries[username] = creators[username]
+
+    if shard_errors:
+        print(f"Leaderboard shards that could not be read: {shard_errors}")
+    return entries
+
+
+def read_summaries(s3, bucket, index_name, usernames, cache=None):
+    # Returns {username: {"top_score", "video_count"}} for the requested creators found in
+    # the index
+    return {username: {"top_score": entry.get('top_score'), "video_count": entry.get('video_count', 0)}
+            for username, entry in _read_entries(s3, bucket, index_name, usernames, cache).items()}
+
+
+def index_versions(s3, bucket, index_name, usernames):
+    # Returns {username: version} for the requested creators found in the index, None for
+    # entries written without one. Lets a writer find creators whose entry is behind.
+    return {username: entry.get('version')
+            for username, entry in _read_entries(s3, bucket, index_name, usernames).items()}
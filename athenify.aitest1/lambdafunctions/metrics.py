@@ -0,0 +1,112 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import coldstart
+
+# Per-invocation spans (timed stages and calls) and counters, printed as one JSON line when
+# the handler returns. Lambda runs one event per container at a time, so the collector is a
+# module global that worker threads record into as well. Set METRICS_ENABLED=false to turn
+# recording and the line off.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+
+class Metrics:
+    def __init__(self, handler_name=None):
+        self.handler_name = handler_name
+        self.started = time.perf_counter()
+        self.spans = {}  # name -> [count, total ms]
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed_ms):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [1, elapsed_ms]
+            else:
+                span[0] += 1
+                span[1] += elapsed_ms
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "spans": {name: {"count": count, "ms": round(total_ms, 3)} for name, (count, total_ms) in self.spans.items()},
+                "counters": dict(self.counters)
+            }
+
+
+_current = Metrics()
+
+
+def start(handler_name):
+    global _current
+    _current = Metrics(handler_name)
+    return _current
+
+
+def record(name, elapsed_ms):
+    if METRICS_ENABLED:
+        _current.record(name, elapsed_ms)
+
+
+def incr(name, value=1):
+    if METRICS_ENABLED:
+        _current.incr(name, value)
+
+
+@contextmanager
+def span(name):
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.record(name, (time.perf_counter() - started) * 1000)
+
+
+def emit(**fields):
+    # Prints the invocation's metrics line and returns it as a dict
+    line = {
+        "metric_type": "invocation",
+        "handler": _current.handler_name,
+        "duration_ms": round((time.perf_counter() - _current.started) * 1000, 3)
+    }
+    line.update(fields)
+    line.update(_current.to_dict())
+    if METRICS_ENABLED:
+        print(json.dumps(line, separators=(",", ":"), default=str))
+    return line
+
+
+def instrument(handler_name):
+    # Decorates a lambda_handler: reports the cold start, starts a fresh collector and emits
+    # the metrics line however the handler returns
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            cold_start_ms = coldstart.report(handler_name)
+            start(handler_name)
+            status_code = None
+            try:
+                response = handler(event, context)
+                # api5/api6 return their payload directly, without an API Gateway envelope
+                if isinstance(response, dict):
+                    status_code = response.get("statusCode", response.get("status"))
+                return response
+            except Exception:
+                status_code = "exception"
+                raise
+            finally:
+                emit(status_code=status_code, cold_start_ms=cold_start_ms)
+        return wrapper
+    return decorator
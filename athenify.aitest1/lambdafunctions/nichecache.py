@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from s3fetch import get_s3_client
+
+# In-process entries kept per container, and how long a verdict stays valid. Verdicts are
+# also written to S3 when NICHE_CACHE_BUCKET is set so they survive cold starts.
+CACHE_SIZE = int(os.environ.get("NICHE_CACHE_SIZE", "2048"))
+CACHE_TTL_SECONDS = int(os.environ.get("NICHE_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+CACHE_BUCKET = os.environ.get("NICHE_CACHE_BUCKET")
+CACHE_PREFIX = os.environ.get("NICHE_CACHE_PREFIX", "niche-cache/")
+
+
+def make_cache_key(username, niche, level, nicheinput):
+    # nicheinput is the normalized caption payload for the creator's latest items, so the
+    # key changes as soon as the creator posts something new
+    raw = json.dumps([username, niche, level, nicheinput], separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class NicheCache:
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL_SECONDS, bucket=None, prefix=CACHE_PREFIX):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bucket = bucket
+        self.prefix = prefix
+        self.entries = OrderedDict()  # key -> (verdict, cached_at), oldest first
+        self.lock = threading.Lock()
+        self._s3 = None
+
+    def _client(self):
+        if self._s3 is None:
+            self._s3 = get_s3_client()
+        return self._s3
+
+    def _remember(self, key, verdict, cached_at):
+        with self.lock:
+            self.entries[key] = (verdict, cached_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, key):
+        # Returns the cached verdict, or None on a miss or an expired entry
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                del self.entries[key]
+
+        if not self.bucket:
+            return None
+
+        try:
+            response = self._client().get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+            stored = json.loads(response['Body'].read().decode('utf-8'))
+        except Exception:
+            return None  # NoSuchKey or S3 trouble, fall back to the LLM call
+
+        if now - stored.get('cached_at', 0) > self.ttl:
+            return None
+
+        self._remember(key, stored['passed'], stored['cached_at'])
+        return stored['passed']
+
+    def put(self, key, verdict):
+        cached_at = time.time()
+        self._remember(key, verdict, cached_at)
+
+        if not self.bucket:
+            return
+
+        try:
+            self._client().put_object(
+                Bucket=self.bucket,
+                Key=f"{self.prefix}{key}.json",
+                Body=json.dumps({"passed": verdict, "cached_at": cached_at}),
+                ContentType="application/json"
+            )
+        except Exception as e:
+            print(f"Failed to store niche verdict in S3: {e}")
+
+
+# Shared by every invocation served by this container
+niche_cache = NicheCache(bucket=CACHE_BUCKET)
@@ -0,0 +1,59 @@
+import json
+import os
+
+# Sparse offsets index for JSON arrays written by s3writer.S3JsonArrayWriter: the byte offset
+# of every INDEX_STRIDE-th element, so a page of the array is served with one byte-range GET
+# of roughly limit + INDEX_STRIDE elements instead of downloading and parsing the whole list.
+INDEX_STRIDE = int(os.environ.get("PAGED_ARRAY_INDEX_STRIDE", "100"))
+PAGED_ARRAY_SCHEMA_VERSION = 1
+
+
+def index_key(key):
+    # usernames.json -> usernames.index.json
+    base, dot, extension = key.rpartition(".")
+    return f"{base}.index.{extension}" if dot else f"{key}.index"
+
+
+def build_index(count, size, offsets, stride, etag):
+    return {
+        "schema_version": PAGED_ARRAY_SCHEMA_VERSION,
+        "count": count,
+        "size": size,
+        "stride": stride,
+        "offsets": offsets,
+        "etag": etag
+    }
+
+
+def is_usable(index):
+    return isinstance(index, dict) and index.get('schema_version') == PAGED_ARRAY_SCHEMA_VERSION and bool(index.get('etag'))
+
+
+def read_page(s3, bucket, key, index, offset, limit):
+    # Returns the elements [offset, offset + limit) of the array. The range GET is pinned to the
+    # ETag the index was built for; a ClientError (PreconditionFailed) means the array was
+    # rewritten after the index was read.
+    count = index['count']
+    stride = index['stride']
+    offsets = index['offsets']
+    end = min(offset + limit, count)
+    if offset >= end:
+        return []
+
+    first_block = offset // stride
+    last_block = (end - 1) // stride + 1
+    start_byte = offsets[first_block]
+    # Stop right before the comma that precedes the next indexed element, or the closing bracket
+    end_byte = (offsets[last_block] if last_block < len(offsets) else index['size']) - 2
+
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start_byte}-{end_byte}", IfMatch=index['etag'])
+    raw = response['Body'].read()
+    elements = json.loads(b"[" + raw + b"]")
+    skip = offset - first_block * stride
+    return elements[skip:skip + (end - offset)]
+
+
+def is_stale(e):
+    from botocore.exceptions import ClientError
+
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ("PreconditionFailed", "412")
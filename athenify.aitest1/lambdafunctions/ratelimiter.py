@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+import metrics
+
+# Default pacing for the Instagram scraper API. Override per deployment with the
+# SCRAPER_RATE_LIMIT_RPS / SCRAPER_RATE_LIMIT_BURST environment variables so the
+# handlers run at the provider's quota instead of a hard-coded sleep.
+DEFAULT_RATE = float(os.environ.get("SCRAPER_RATE_LIMIT_RPS", "5"))
+DEFAULT_BURST = float(os.environ.get("SCRAPER_RATE_LIMIT_BURST", "5"))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        self.rate = float(rate)  # Tokens added per second
+        self.capacity = max(1.0, float(burst))  # Maximum tokens that can be saved up
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, tokens=1):
+        # Block until `tokens` are available, then take them
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens and now >= self.updated:
+                    self.tokens -= tokens
+                    if waited:
+                        metrics.record("ratelimit.wait", waited * 1000)
+                    return
+                if now < self.updated:
+                    # The bucket is paused after a 429, wait until it resumes
+                    wait_time = self.updated - now
+                else:
+                    wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def penalize(self, seconds):
+        # Called when the provider answers 429: empty the bucket and stop handing out
+        # tokens for `seconds`, so every caller sharing this bucket backs off together
+        metrics.incr("ratelimit.penalties")
+        with self.lock:
+            self.tokens = 0.0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, rate=None, burst=None):
+    # Limiters live at module scope so they are shared by every caller in the
+    # container and survive warm Lambda invocations
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = TokenBucket(rate or DEFAULT_RATE, burst or DEFAULT_BURST)
+            _limiters[name] = limiter
+        return limiter
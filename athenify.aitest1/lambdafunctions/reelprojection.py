@@ -0,0 +1,73 @@
+import json
+import os
+
+# Bump when PROJECTED_FIELDS changes so readers ignore artifacts written with an older layout
+PROJECTED_SCHEMA_VERSION = 1
+PROJECTED_REELS_ENABLED = os.environ.get("PROJECTED_REELS_ENABLED", "true").lower() == "true"
+
+# The media fields api5.parse_video_metadata reads. None keeps the value as is, a dict keeps
+# only the listed keys and a one-element list applies its spec to every list item.
+PROJECTED_FIELDS = {
+    'like_count': None,
+    'comment_count': None,
+    'play_count': None,
+    'has_liked': None,
+    'caption': {'text': None},
+    'usertags': {'in': [{'user': {'username': None, 'is_verified': None}}]},
+    'clips_metadata': {
+        'original_sound_info': {'audio_asset_id': None},
+        'mashup_info': {'mashups_allowed': None, 'non_privacy_filtered_mashups_media_count': None}
+    },
+    'video_versions': [{'width': None, 'url': None}],
+    'video_duration': None,
+    'has_audio': None,
+    'user': {'is_private': None, 'is_verified': None, 'profile_pic_url': None, 'username': None},
+    'can_viewer_save': None,
+    'can_viewer_reshare': None,
+    'logging_info_token': None,
+    'organic_tracking_token': None
+}
+
+
+def projected_key(username):
+    return f"{username}_reels_projected.json"
+
+
+def projection_metadata(raw_etag):
+    # Stored with the projection: the ETag of the raw payload it was projected from, so
+    # readers can tell a projection that missed a later raw write
+    return {"source-etag": (raw_etag or "").strip('"')}
+
+
+def is_current_projection(metadata, raw_etag):
+    source_etag = (metadata or {}).get("source-etag")
+    return bool(source_etag) and source_etag == (raw_etag or "").strip('"')
+
+
+def _project(value, spec):
+    # Keys missing from the source stay missing (and None stays None) so the projected
+    # media parses exactly like the raw one
+    if isinstance(spec, dict) and isinstance(value, dict):
+        return {key: _project(value[key], sub_spec) for key, sub_spec in spec.items() if key in value}
+    if isinstance(spec, list) and isinstance(value, list):
+        return [_project(item, spec[0]) for item in value]
+    return value
+
+
+def project_reels(data):
+    # Same {"data": {"items": [{"media": ...}]}} shape as the scraper payload, so
+    # api5.parse_and_rank_videos reads either one
+    items = data.get('data', {}).get('items', []) if isinstance(data, dict) else []
+    return {
+        "schema_version": PROJECTED_SCHEMA_VERSION,
+        "data": {
+            "items": [
+                {"media": _project(item.get('media'), PROJECTED_FIELDS)}
+                for item in items if isinstance(item, dict) and item.get('media')
+            ]
+        }
+    }
+
+
+def encode_projected_reels(data):
+    return json.dumps(project_reels(data), separators=(",", ":"))
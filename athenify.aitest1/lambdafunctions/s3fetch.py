@@ -0,0 +1,109 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+
+# Worker threads for per-creator S3 reads. botocore keeps 10 connections per client by
+# default, so the client's pool is sized to match or the extra workers just queue.
+S3_FETCH_WORKERS = int(os.environ.get("S3_FETCH_WORKERS", "32"))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", str(S3_FETCH_WORKERS)))
+
+THROTTLING_CODES = ("SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "503")
+
+# Client calls recorded as "s3.<operation>" spans in the invocation's metrics
+TIMED_OPERATIONS = frozenset([
+    "get_object", "put_object", "head_object", "delete_object", "upload_file", "list_objects_v2",
+    "create_multipart_upload", "upload_part", "complete_multipart_upload", "abort_multipart_upload"
+])
+
+
+def make_s3_client():
+    # boto3 is imported on first use, so requests that fail validation never load it
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        's3',
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS, retries={'max_attempts': 5, 'mode': 'adaptive'})
+    )
+
+
+class LazyS3Client:
+    # Stands in for the S3 client at module scope. The real client is built on the first
+    # attribute access and then reused by every warm invocation of the container.
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = make_s3_client()
+        return self._client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._get(), name)
+        if name in TIMED_OPERATIONS:
+            return _timed(name, attribute)
+        return attribute
+
+
+def _timed(name, operation):
+    def call(*args, **kwargs):
+        body = kwargs.get("Body")
+        if isinstance(body, (bytes, str)):
+            metrics.incr("s3.bytes_out", len(body))
+        try:
+            with metrics.span(f"s3.{name}"):
+                response = operation(*args, **kwargs)
+        except Exception:
+            metrics.incr(f"s3.{name}.errors")  # Includes misses and 304s on conditional reads
+            raise
+        if isinstance(response, dict) and isinstance(response.get("ContentLength"), int) and name == "get_object":
+            metrics.incr("s3.bytes_in", response["ContentLength"])
+        return response
+    return call
+
+
+_s3_client = LazyS3Client()
+
+
+def get_s3_client():
+    # The one S3 client of the process, shared by the handler and the helper modules
+    return _s3_client
+
+
+def classify_error(e):
+    from botocore.exceptions import ClientError
+
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        if code in ("NoSuchKey", "404"):
+            return "not_found"
+        if code in THROTTLING_CODES:
+            return "throttled"
+    return "failed"
+
+
+def fetch_concurrently(load, names, max_workers=S3_FETCH_WORKERS, errors=None):
+    # Runs load(name) on a thread pool and yields (name, result) in completion order. Failed
+    # names are recorded in errors under "not_found", "throttled" or "failed" and skipped.
+    if errors is None:
+        errors = {}
+    if not names:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names)))) as executor:
+        futures = {executor.submit(load, name): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                kind = classify_error(e)
+                errors.setdefault(kind, []).append(name)
+                print(f"Error reading S3 object for {name} ({kind}): {e}")
+                continue
+            yield name, result
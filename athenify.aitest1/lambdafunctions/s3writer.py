@@ -0,0 +1,89 @@
+import json
+
+from pagedarray import build_index, index_key
+
+# S3 requires every multipart part except the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3JsonArrayWriter:
+    # Streams a JSON array to S3 one element at a time. Small arrays end up as a single
+    # put_object; once the buffer reaches part_size the writer switches to a multipart upload,
+    # so the writer's own buffer stays bounded by one part however long the array gets (what
+    # the caller keeps of the elements is up to the caller). Nothing is visible in
+    # S3 until close() succeeds. With index_stride set, close() also writes a pagedarray
+    # offsets index next to the array.
+    def __init__(self, s3, bucket, key, part_size=MIN_PART_SIZE, content_type="application/json", index_stride=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.buffer = bytearray(b"[")
+        self.count = 0
+        self.bytes_written = 0
+        self.upload_id = None
+        self.parts = []
+        self.index_stride = index_stride
+        self.offsets = []
+        self.etag = None
+
+    def append(self, value):
+        if self.count:
+            self.buffer += b","
+        if self.index_stride and self.count % self.index_stride == 0:
+            self.offsets.append(self.bytes_written + len(self.buffer))
+        self.buffer += json.dumps(value, separators=(",", ":")).encode("utf-8")
+        self.count += 1
+        if len(self.buffer) >= self.part_size:
+            self._flush_part()
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({"ETag": response['ETag'], "PartNumber": part_number})
+        self.bytes_written += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.buffer += b"]"
+        if self.upload_id is None:
+            response = self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            self.bytes_written += len(self.buffer)
+            self.buffer = bytearray()
+        else:
+            self._flush_part()
+            response = self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts}
+            )
+        self.etag = (response or {}).get('ETag')
+
+        if self.index_stride and self.etag:
+            index = build_index(self.count, self.bytes_written, self.offsets, self.index_stride, self.etag)
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=index_key(self.key),
+                Body=json.dumps(index, separators=(",", ":")),
+                ContentType="application/json"
+            )
+
+    def abort(self):
+        # Drop the uploaded parts so a failed ingest leaves the previous object untouched
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print(f"Failed to abort multipart upload for {self.key}: {e}")
+            self.upload_id = None
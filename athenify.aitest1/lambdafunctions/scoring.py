@@ -0,0 +1,14 @@
+# Performance score weights as (likes, comments, plays). api5 ranks each creator's videos
+# with CREATOR_WEIGHTS and api6 ranks across creators with LEADERBOARD_WEIGHTS.
+CREATOR_WEIGHTS = (0.4, 0.3, 0.3)
+LEADERBOARD_WEIGHTS = (0.65, 0.3, 0.05)
+
+
+def performance_score(video, weights):
+    weight_likes, weight_comments, weight_plays = weights
+    
+    like_score = video.get('like_count', 0) * weight_likes
+    comment_score = video.get('comment_count', 0) * weight_comments
+    play_score = video.get('play_count', 0) * weight_plays
+    
+    return like_score + comment_score + play_score